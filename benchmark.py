@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core import Database, Entry, Image, Matcher
+from core.augments import Augment, ArrowAugment, BoxAugment, EllipseAugment
+from core.backends import BACKENDS, DEFAULT_BACKEND
+from core.pipeline import recognize
+from core.projection import project
+from core.resolution import ResolutionPolicy
+from log import logger
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'images')
+# as imagens "<landmark>-1.*" são as entries de referência; todas as outras são queries desse landmark
+REFERENCE = re.compile(r'^(?P<landmark>.+)-1\.(png|jpe?g)$')
+LANDMARK = re.compile(r'^(?P<landmark>.+)-[^-]+\.(png|jpe?g)$')
+# métricas comparadas no modo --compare; para todas, um valor maior é pior
+COMPARED = ('p50_ms', 'p95_ms', 'peak_kib')
+# lados maiores testados na curva latência/precisão (0 = resolução original)
+CURVE_EDGES = '320,480,640,800,0'
+
+
+def landmark(filename: str) -> str:
+    return LANDMARK.match(filename).group('landmark')
+
+
+# Mede uma etapa: latência de cada execução e pico de memória alocada pelo Python/numpy
+# (o tracemalloc não vê as alocações internas do OpenCV). Como o tracemalloc torna as alocações
+# mais lentas, a memória é medida em execuções à parte, que não contam para a latência
+class Stage:
+    def __init__(self):
+        self.samples: List[float] = []
+        self.peak = 0
+
+    def run(self, traced: bool, fn: Callable, *args):
+        if traced:
+            tracemalloc.start()
+            try:
+                return fn(*args)
+            finally:
+                self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.samples.append(time.perf_counter() - start)
+
+    def report(self) -> dict:
+        samples = np.array(self.samples) * 1000
+        return {'samples': len(samples),
+                'p50_ms': float(np.percentile(samples, 50)),
+                'p95_ms': float(np.percentile(samples, 95)),
+                'mean_ms': float(samples.mean()),
+                'throughput_per_s': float(1000 / samples.mean()),
+                'peak_kib': self.peak / 1024}
+
+
+def load_images(directory: str) -> Tuple[Dict[str, Image], Dict[str, Image]]:
+    references, queries = OrderedDict(), OrderedDict()
+    for filename in sorted(os.listdir(directory)):
+        if not LANDMARK.match(filename):
+            continue
+        image = Image.from_file(os.path.join(directory, filename))
+        (references if REFERENCE.match(filename) else queries)[filename] = image
+    return references, queries
+
+
+# um augment de cada tipo com contorno, proporcional ao tamanho da imagem da entry
+def reference_augments(image: Image) -> List[Augment]:
+    h, w = image.dimensions[:2]
+    return [BoxAugment(w // 10, h // 10, w // 3, h // 4),
+            EllipseAugment(w // 2, h // 2, w // 4, h // 3),
+            ArrowAugment(w // 5, h * 3 // 4, max(w // 3, 60), -30)]
+
+
+def build_database(filename: str, matcher: Matcher, references: Dict[str, Image],
+                   preprocessing: Optional[List[dict]] = None) -> Database:
+    database = Database.connect(filename, backend=matcher.backend.name, preprocessing=preprocessing)
+    matcher.attach(database)
+    for name, image in references.items():
+        features = matcher.features(matcher.preprocess(image))
+        database.add_entry(Entry.from_features(landmark(name), image, features, augments=reference_augments(image),
+                                               group='benchmark'))
+    return database
+
+
+# o mesmo trabalho que o show_recognition faz no modo raster com a imagem dos augments
+def warp(entry: Entry, image: Image, matrix: np.ndarray) -> np.ndarray:
+    h, w = entry.img.dimensions[:2]
+    overlay = np.zeros((h, w, 4), dtype=np.uint8)
+    h, w = image.dimensions[:2]
+    return cv2.warpPerspective(overlay, matrix, (w, h))
+
+
+def run(database: Database, matcher: Matcher, queries: Dict[str, Image], repeat: int, warmup: int) -> dict:
+    stages = OrderedDict((name, Stage()) for name in ('equalize', 'features', 'match', 'homography', 'project',
+                                                      'warp', 'recognize'))
+    correct = 0
+    for name, image in queries.items():
+        expected = landmark(name)
+        for __ in range(warmup):
+            recognize(image, database, matcher)
+        # a primeira execução só mede a memória
+        for i in range(repeat + 1):
+            traced = i == 0
+            image_eq = stages['equalize'].run(traced, matcher.preprocess, image)
+            kp, des = stages['features'].run(traced, matcher.features_raw, image_eq)
+            candidates = stages['match'].run(traced, database.candidates, matcher, des)
+            if candidates:
+                entry, matches = candidates[0]
+                src_pts = entry.points[[m.queryIdx for m in matches]].reshape(-1, 1, 2)
+                dst_pts = np.float32([kp[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+                matrix, __ = stages['homography'].run(traced, cv2.findHomography, src_pts, dst_pts, cv2.RANSAC, 5.0)
+                if matrix is not None:
+                    # os augments são projetados como geometria; o warp da imagem dos augments só é usado
+                    # no modo raster
+                    stages['project'].run(traced, project, entry.augments, matrix)
+                    stages['warp'].run(traced, warp, entry, image, matrix)
+            result = stages['recognize'].run(traced, recognize, image, database, matcher)
+        predicted = result.entry.name if result.matched else None
+        correct += predicted == expected
+        logger.info('%s: expected %s, got %s', name, expected, predicted)
+    return {'stages': OrderedDict((name, stage.report()) for name, stage in stages.items() if stage.samples),
+            'accuracy': correct / len(queries) if queries else 0.0,
+            'queries': len(queries)}
+
+
+# Curva latência/precisão: o reconhecimento completo com as imagens de query reduzidas a cada lado maior
+def resolution_curve(database: Database, matcher: Matcher, queries: Dict[str, Image], repeat: int,
+                     edges: List[int], max_key_points: Optional[int]) -> List[dict]:
+    curve = []
+    for edge in edges:
+        policy = ResolutionPolicy(edge or None, max_key_points)
+        stage, correct, key_points = Stage(), 0, 0
+        for name, image in queries.items():
+            for __ in range(repeat):
+                result = stage.run(False, recognize, image, database, matcher, None, None, policy)
+            correct += result.matched and result.entry.name == landmark(name)
+            key_points += len(result.key_points)
+        report = stage.report()
+        curve.append({'max_edge': edge,
+                      'p50_ms': report['p50_ms'],
+                      'p95_ms': report['p95_ms'],
+                      'key_points': key_points / len(queries) if queries else 0.0,
+                      'accuracy': correct / len(queries) if queries else 0.0})
+    return curve
+
+
+# compara os resultados com uma baseline; retorna as regressões acima do limite
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    regressions = []
+    for name, stage in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            continue
+        for metric in COMPARED:
+            if base[metric] > 0 and (stage[metric] - base[metric]) / base[metric] > threshold:
+                regressions.append('%s.%s: %.2f -> %.2f (+%.0f%%)' % (name, metric, base[metric], stage[metric],
+                                                                   100 * (stage[metric] / base[metric] - 1)))
+    if results['accuracy'] < baseline['accuracy']:
+        regressions.append('accuracy: %.3f -> %.3f' % (baseline['accuracy'], results['accuracy']))
+    return regressions
+
+
+def print_report(results: dict, out=sys.stdout):
+    out.write('%-12s %8s %10s %10s %12s %12s\n' % ('stage', 'samples', 'p50 ms', 'p95 ms', 'ops/s', 'peak KiB'))
+    for name, stage in results['stages'].items():
+        out.write('%-12s %8d %10.2f %10.2f %12.2f %12.1f\n' % (name, stage['samples'], stage['p50_ms'],
+                                                              stage['p95_ms'], stage['throughput_per_s'],
+                                                              stage['peak_kib']))
+    out.write('accuracy: %.3f (%d queries)\n' % (results['accuracy'], results['queries']))
+    if results.get('curve'):
+        out.write('\n%-12s %10s %10s %12s %10s\n' % ('max edge', 'p50 ms', 'p95 ms', 'key points', 'accuracy'))
+        for point in results['curve']:
+            out.write('%-12s %10.2f %10.2f %12.0f %10.3f\n' % (point['max_edge'] or 'full', point['p50_ms'],
+                                                               point['p95_ms'], point['key_points'],
+                                                               point['accuracy']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the recognition stages over resources/images')
+    parser.add_argument('--images', default=IMAGES_DIR, help='directory with <landmark>-<n> images')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='measured runs per query image')
+    parser.add_argument('--warmup', type=int, default=1, help='unmeasured runs per query image')
+    parser.add_argument('-b', '--backend', default=DEFAULT_BACKEND, choices=sorted(BACKENDS),
+                        help='feature backend (default: %s)' % DEFAULT_BACKEND)
+    parser.add_argument('-t', '--threads', type=int, default=1, help='OpenCV threads')
+    parser.add_argument('--curve', default=CURVE_EDGES, metavar='EDGES',
+                        help='comma separated query long edges for the latency/accuracy curve, 0 for full '
+                             'resolution, empty to skip (default: %s)' % CURVE_EDGES)
+    parser.add_argument('--max-key-points', type=int, default=None,
+                        help='key point budget of the query images in the curve')
+    parser.add_argument('--preprocessing', type=json.loads, default=None, metavar='JSON',
+                        help='preprocessing stages of the benchmark database (default: grayscale and CLAHE)')
+    parser.add_argument('--save', metavar='JSON', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='JSON', help='compare the results against a baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative increase over the baseline reported as a regression (default: 0.1)')
+    args = parser.parse_args(argv)
+
+    cv2.setNumThreads(args.threads)
+    # RANSAC usa o gerador do OpenCV; fixar a seed torna as execuções comparáveis
+    cv2.setRNGSeed(0)
+    references, queries = load_images(args.images)
+    directory = tempfile.mkdtemp(prefix='rvau-benchmark-')
+    try:
+        matcher = Matcher(args.backend)
+        database = build_database(os.path.join(directory, 'benchmark.db'), matcher, references, args.preprocessing)
+        results = run(database, matcher, queries, args.repeat, args.warmup)
+        edges = [int(edge) for edge in args.curve.split(',') if edge.strip()]
+        results['curve'] = resolution_curve(database, matcher, queries, args.repeat, edges, args.max_key_points)
+    finally:
+        shutil.rmtree(directory)
+    results['meta'] = {'python': platform.python_version(),
+                       'opencv': cv2.__version__,
+                       'numpy': np.__version__,
+                       'machine': platform.machine(),
+                       'backend': args.backend,
+                       'preprocessing': matcher.preprocessing.to_config(),
+                       'threads': args.threads,
+                       'repeat': args.repeat,
+                       'references': list(references)}
+    print_report(results)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            sys.exit(1)
+        print('No regressions above %.0f%%' % (100 * args.threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,20 @@ class Augment(ABC):
     def __init__(self, type: AugmentType):
         self.type = type
 
+    # cria um augment a partir de um dict (ex: de um ficheiro JSON), com o tipo pelo nome: {"type": "box", ...}
+    @staticmethod
+    def from_dict(data: dict) -> 'Augment':
+        data = dict(data)
+        name = str(data.pop('type', '')).upper()
+        try:
+            cls = AUGMENT_CLASSES[AugmentType[name]]
+        except KeyError:
+            raise ValueError("Unsupported augment type '%s'" % name.lower())
+        try:
+            return cls(**data)
+        except TypeError as error:
+            raise ValueError('Invalid %s augment: %s' % (name.lower(), error))
+
 
 class BoxAugment(Augment):
     def __init__(self, x, y, w, h):
@@ -40,3 +54,6 @@ class EllipseAugment(Augment):
         self.y = y
         self.w = w
         self.h = h
+
+
+AUGMENT_CLASSES = {AugmentType.BOX: BoxAugment, AugmentType.ARROW: ArrowAugment, AugmentType.ELLIPSE: EllipseAugment}
@@ -0,0 +1,113 @@
+from typing import Callable, Dict
+
+import cv2
+import numpy as np
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+RATIO_TEST = 0.7
+ORB_FEATURES = 2000
+
+
+# função do OpenCV que cria um detetor; alguns detetores mudaram entre o módulo principal e o
+# xfeatures2d (ex: o AKAZE não está no módulo principal do OpenCV 5)
+def opencv_factory(name: str) -> Callable[..., cv2.Feature2D]:
+    for module in (cv2, getattr(cv2, 'xfeatures2d', None)):
+        factory = getattr(module, name, None)
+        if factory is not None:
+            return factory
+    raise ValueError('OpenCV %s does not provide %s' % (cv2.__version__, name))
+
+
+# Backend de deteção/descrição de features usado pelo Matcher. Cada base de dados guarda o nome
+# do backend que produziu os seus descritores, porque descritores de backends diferentes não são comparáveis
+class Backend:
+    name: str = None
+    # descritores binários (uint8) comparados pela distância de Hamming
+    binary: bool = False
+    # o OpenCV não consegue carregar indexes LSH guardados em disco
+    persistent_index: bool = True
+
+    def create(self) -> cv2.Feature2D:
+        raise NotImplementedError
+
+    # cria o detetor uma vez, para que um backend que o OpenCV instalado não suporta seja detetado
+    # antes de lançar processos (um initializer que falha deixa o multiprocessing.Pool bloqueado)
+    def check(self):
+        try:
+            self.create()
+        except (AttributeError, cv2.error) as error:
+            raise ValueError("The '%s' feature backend is not available in OpenCV %s: %s"
+                             % (self.name, cv2.__version__, error))
+
+    # identifica o detetor e os seus parâmetros (ex: para a chave da cache de features)
+    @property
+    def signature(self) -> str:
+        return self.name
+
+    def index_params(self) -> dict:
+        raise NotImplementedError
+
+    # distância verdadeira a partir da distância devolvida pelo index
+    def distance(self, distances: np.ndarray) -> np.ndarray:
+        return distances
+
+    # store all the good matches as per Lowe's ratio test.
+    # vizinhos em falta (o LSH pode devolver menos do que k) têm índice -1
+    def ratio_test(self, indices: np.ndarray, distances: np.ndarray) -> np.ndarray:
+        found = (indices[:, 0] >= 0) & (indices[:, 1] >= 0)
+        distances = self.distance(distances.astype(np.float32))
+        return found & (distances[:, 0] < RATIO_TEST * distances[:, 1])
+
+
+class SiftBackend(Backend):
+    name = 'sift'
+
+    def create(self):
+        return opencv_factory('SIFT_create')()
+
+    def index_params(self):
+        return dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+
+    # the KD-tree index returns squared L2 distances
+    def distance(self, distances):
+        return np.sqrt(distances)
+
+
+# Backends binários: descritores 16x mais pequenos que os do SIFT (32 bytes no ORB em vez de 128 floats),
+# indexados com LSH
+class BinaryBackend(Backend):
+    binary = True
+    persistent_index = False
+
+    def index_params(self):
+        return dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+
+
+class OrbBackend(BinaryBackend):
+    name = 'orb'
+
+    def create(self):
+        return opencv_factory('ORB_create')(nfeatures=ORB_FEATURES)
+
+    @property
+    def signature(self):
+        return '%s(nfeatures=%d)' % (self.name, ORB_FEATURES)
+
+
+class AkazeBackend(BinaryBackend):
+    name = 'akaze'
+
+    def create(self):
+        return opencv_factory('AKAZE_create')()
+
+
+BACKENDS: Dict[str, Backend] = {b.name: b for b in (SiftBackend(), OrbBackend(), AkazeBackend())}
+DEFAULT_BACKEND = SiftBackend.name
+
+
+def backend(name: str) -> Backend:
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown feature backend '%s' (available: %s)" % (name, ', '.join(BACKENDS)))
@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+# Cache LRU limitada por um orçamento de bytes: quando o orçamento é ultrapassado,
+# os valores usados há mais tempo são removidos (e passados a `on_evict`, se existir)
+class LRUCache:
+    def __init__(self, max_bytes: int, on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.on_evict = on_evict
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key: Hashable):
+        return key in self._items
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            self._items.move_to_end(key)
+            return item[0]
+
+    # por omissão o tamanho de um valor é o dos seus dados (np.ndarray.nbytes)
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None):
+        size = value.nbytes if size is None else size
+        evicted = []
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                old_key, (old_value, old_size) = self._items.popitem(last=False)
+                self.bytes -= old_size
+                evicted.append((old_key, old_value))
+        # chamado fora do lock, para que o callback possa usar a cache
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def _pop(self, key: Hashable):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
@@ -0,0 +1,36 @@
+import threading
+from typing import Callable, Optional
+
+# função chamada com a etapa atual e a fração do trabalho já feita (entre 0 e 1)
+ProgressCallback = Callable[[str, float], None]
+
+
+class Cancelled(Exception):
+    pass
+
+
+# Pedido de cancelamento partilhado entre quem lançou um trabalho e a thread que o executa.
+# O trabalho não é interrompido a meio de uma etapa: é verificado entre etapas com check()
+class CancellationToken:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled()
+
+
+# verifica o cancelamento (se houver token) e reporta o progresso (se houver callback)
+def checkpoint(token: Optional[CancellationToken], progress: Optional[ProgressCallback], stage: str,
+               fraction: float):
+    if token is not None:
+        token.check()
+    if progress is not None:
+        progress(stage, fraction)
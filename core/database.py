@@ -1,75 +1,391 @@
-import pickle
-from cv2 import KeyPoint
-from typing import List, Optional
+from cv2 import DMatch, KeyPoint
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 import numpy as np
 
 from core import Image, Feature
+from core import instrumentation
+from core.backends import DEFAULT_BACKEND, SiftBackend, backend as get_backend
+from core.cache import LRUCache
+from core.cancellation import CancellationToken, ProgressCallback, checkpoint
+from core.image import LazyImage, IMAGE_CACHE_BYTES
+from core.feature import KEY_POINT_DTYPE, array_to_key_points, key_point_positions
 from core.augments import Augment
+from core.preprocessing import DEFAULT_PREPROCESSING_CONFIG, Preprocessing
+from core.storage import Store, FORMAT_VERSION
+from core.index import DescriptorIndex, CANDIDATES, INDEX_KEY, SHARD_CACHE_BYTES, entry_key, shard_key
+from core.matcher import MIN_MATCH_COUNT
+from core.vocabulary import BRANCHING, DEPTH, SHORTLIST, InvertedFile, Vocabulary
 from log import logger
 
 
 # Entry é a classe onde usamos para guardar a imagem, as suas features,e as suas propriedades de aumento
-# Ver o feature.py, image.py dentro desta pasta
+# As features são guardadas em colunas: uma matriz contígua com os descritores e um array estruturado
+# com os key points (ver KEY_POINT_DTYPE em feature.py). Ver o feature.py, image.py dentro desta pasta
 
 class Entry:
-    def __init__(self, name: str, image: Image, features: List[Feature], augments: Optional[List[Augment]] = None,
-                 group=None):
+    def __init__(self, name: str, image: Image, key_points: np.ndarray, descriptors: np.ndarray,
+                 augments: Optional[List[Augment]] = None, group=None):
+        assert len(key_points) == len(descriptors), 'Every key point needs a descriptor'
         self.name = name
         self.img: Image = image
         self.augments = augments if augments is not None else []
-        self.features = features
+        self._key_points: np.ndarray = np.ascontiguousarray(key_points, dtype=KEY_POINT_DTYPE)
+        self._descriptors: np.ndarray = np.ascontiguousarray(descriptors)
+        self._key_point_objects: Optional[List[KeyPoint]] = None
         self.group: Optional[str] = group
+        # palavra visual de cada descritor, segundo o vocabulário da base de dados (None se não houver)
+        self.words: Optional[np.ndarray] = None
 
-    # função que retorna o array com os descritores de cada feature
+    @classmethod
+    def from_features(cls, name: str, image: Image, features: List[Feature], augments: Optional[List[Augment]] = None,
+                      group=None) -> 'Entry':
+        key_points = np.array([f.record for f in features], dtype=KEY_POINT_DTYPE)
+        descriptors = np.array([f.descriptor for f in features])
+        return cls(name, image, key_points, descriptors, augments=augments, group=group)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_key_point_objects'] = None
+        return state
+
+    # converte Entries guardadas com a lista de Feature antiga para o formato em colunas
+    def __setstate__(self, state):
+        features = state.pop('features', None)
+        self.words = None
+        self.__dict__.update(state)
+        if features is not None:
+            self._key_points = np.array([f.record for f in features], dtype=KEY_POINT_DTYPE)
+            self._descriptors = np.array([f.descriptor for f in features], dtype=np.float32)
+            self._key_point_objects = None
+
+    def __len__(self):
+        return len(self._key_points)
+
+    # passa a usar os arrays guardados pela base de dados (mapeados em memória) em vez das cópias próprias
+    def bind(self, key_points: np.ndarray, descriptors: np.ndarray):
+        assert len(key_points) == len(self._key_points) and len(descriptors) == len(self._descriptors)
+        self._key_points = key_points
+        self._descriptors = descriptors
+
+    # função que retorna a matriz com os descritores de cada feature (sem cópia).
+    # O tipo depende do backend da base de dados: float32 (SIFT) ou uint8 (descritores binários)
     @property
     def descriptors(self) -> np.ndarray:
-        return np.array([f.descriptor for f in self.features])
+        return self._descriptors
 
-    # retorna uma lista com todos os pontos-chave de todas as features
+    # array estruturado com os key points (sem cópia)
+    @property
+    def key_point_array(self) -> np.ndarray:
+        return self._key_points
+
+    # posições (N, 2) de todos os key points, para recolher pontos de forma vetorizada
+    @property
+    def points(self) -> np.ndarray:
+        return key_point_positions(self._key_points)
+
+    # retorna uma lista com todos os pontos-chave de todas as features; só é construída uma vez
     @property
     def key_points(self) -> List[KeyPoint]:
-        return [f.key_point for f in self.features]
+        if self._key_point_objects is None:
+            self._key_point_objects = array_to_key_points(self._key_points)
+        return self._key_point_objects
+
+    # Features individuais, criadas a pedido para a GUI
+    @property
+    def features(self) -> List[Feature]:
+        return [Feature.from_record(r, d) for r, d in zip(self._key_points, self._descriptors)]
 
 
 # abstração onde se guarda o conjunto das Entry para se poder gerir uma base de dados
 class Database:
-    def __init__(self, filename):
+    def __init__(self, filename, image_cache_bytes: int = IMAGE_CACHE_BYTES, shard_cache_bytes: int = SHARD_CACHE_BYTES):
         self.filename = filename
+        # cache partilhada pelas imagens descodificadas de todas as entries
+        self.images = LRUCache(image_cache_bytes)
         self.__entries = dict()
+        self.__index: Optional[DescriptorIndex] = None
+        # indexes de cada grupo, construídos quando uma query os pede e descartados pelos menos usados
+        self.__shards = LRUCache(shard_cache_bytes, on_evict=self.__shard_evicted)
+        self.__listeners: List[Callable[[str], None]] = []
+        self.__evict_listeners: List[Callable[[str], None]] = []
+        self.__store = Store(filename)
+        self.__records: Dict[str, dict] = dict()
+        self.__inverted: Optional[InvertedFile] = None
+        self.__preprocessing: Optional[Preprocessing] = None
+
+    # usado apenas para ler bases de dados antigas, guardadas como um pickle do objeto Database
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__index = None
+        self.__shards = LRUCache(SHARD_CACHE_BYTES, on_evict=self.__shard_evicted)
+        self.__listeners = []
+        self.__evict_listeners = []
+        self.__store = Store(self.filename)
+        self.__records = dict()
+        self.__inverted = None
+        self.__preprocessing = None
+        self.images = LRUCache(IMAGE_CACHE_BYTES)
+
+    # regista uma função que é chamada com a chave de cada index invalidado por uma alteração,
+    # e opcionalmente outra chamada com a chave de cada shard descarregado da memória
+    def subscribe(self, listener: Callable[[str], None], on_evict: Optional[Callable[[str], None]] = None):
+        self.__listeners.append(listener)
+        if on_evict is not None:
+            self.__evict_listeners.append(on_evict)
 
-    # método para a ligação à base de dados
+    def __changed(self, entry: Entry):
+        self.__index = None
+        self.__shards.discard(shard_key(entry.group))
+        for listener in self.__listeners:
+            listener(entry_key(entry.name))
+            listener(shard_key(entry.group))
+            listener(INDEX_KEY)
+
+    def __shard_evicted(self, key: str, shard: DescriptorIndex):
+        logger.debug('Evicting shard %s (%d descriptors)', key, len(shard))
+        for listener in self.__evict_listeners:
+            listener(key)
+
+    # método para a ligação à base de dados: lê apenas o índice; os descritores e key points
+    # ficam mapeados em memória. Bases de dados antigas (pickle) são migradas para o formato novo
+    # O backend de features e o preprocessamento (lista de etapas, ver preprocessing.py) só são usados
+    # quando a base de dados é criada; pedir valores diferentes dos de uma base de dados existente é um erro
     @classmethod
-    def connect(cls, filename):
-        try:
-            file = open(filename, 'rb')
-        except FileNotFoundError:
-            db = cls(filename)
+    def connect(cls, filename, backend: Optional[str] = None, image_cache_bytes: int = IMAGE_CACHE_BYTES,
+                shard_cache_bytes: int = SHARD_CACHE_BYTES, preprocessing: Optional[List[dict]] = None):
+        # validado antes de criar ficheiros
+        requested = Preprocessing.from_config(preprocessing) if preprocessing is not None else None
+        db = cls(filename, image_cache_bytes, shard_cache_bytes)
+        store = db.__store
+        if store.is_legacy():
+            logger.info('Migrating database to format %d: %s', FORMAT_VERSION, filename)
+            db.__entries = store.read_legacy()
+            store.meta['backend'] = SiftBackend.name
+            store.backup_legacy()
             db.save()
-            return db
+            store.finish_migration()
+        elif store.exists():
+            db.__records = store.load()
+            for name, record in db.__records.items():
+                image = LazyImage(store.image_loader(record), store.image_shape(record), db.images)
+                entry = Entry(name, image, store.key_points(record), store.descriptors(record),
+                              augments=record['augments'], group=record['group'])
+                entry.words = store.words(record)
+                db.__entries[name] = entry
         else:
-            return pickle.load(file)
+            store.meta['backend'] = get_backend(backend or DEFAULT_BACKEND).name
+            if requested is not None:
+                store.meta['preprocessing'] = requested.to_config()
+            db.save()
+        if backend is not None and backend != db.backend:
+            raise ValueError("Database %s was built with the '%s' backend, not '%s'" % (filename, db.backend, backend))
+        if requested is not None and requested != db.preprocessing:
+            raise ValueError("Database %s was built with the '%s' preprocessing, not '%s'"
+                             % (filename, db.preprocessing, requested))
+        db.__load_vocabulary()
+        return db
 
-    # gravação do estado da base de dados para permitir que se reutilize as Entry
+    # nome do backend de features (ver backends.py) que produziu os descritores desta base de dados
+    @property
+    def backend(self) -> str:
+        return self.__store.meta.get('backend', SiftBackend.name)
+
+    # etapas aplicadas às imagens antes da extração de features, tanto nas entries como nas queries.
+    # Bases de dados sem esta configuração foram criadas com o preprocessamento por omissão
+    @property
+    def preprocessing(self) -> Preprocessing:
+        if self.__preprocessing is None:
+            self.__preprocessing = Preprocessing.from_config(self.__store.meta.get('preprocessing',
+                                                                                   DEFAULT_PREPROCESSING_CONFIG))
+        return self.__preprocessing
+
+    # gravação do estado completo da base de dados (compactação): escreve uma geração nova dos ficheiros
+    # de dados e um índice novo de forma atómica, e descarta o log
     def save(self):
-        with open(self.filename, 'wb') as file:
-            logger.info('Saving database: %s', self.filename)
-            pickle.dump(self, file, pickle.HIGHEST_PROTOCOL)
+        self.__records = self.__store.compact(self.__entries.values())
+        for name, record in self.__records.items():
+            entry = self.__entries[name]
+            entry.bind(self.__store.key_points(record), self.__store.descriptors(record))
+            self.__load_image_from(entry, record)
+
+    # depois de a imagem de uma entry estar escrita, os pixeis só são lidos do disco quando forem precisos
+    # (e ficam na cache partilhada), em vez de a imagem descodificada ficar em memória
+    def __load_image_from(self, entry: Entry, record: dict):
+        if isinstance(entry.img, LazyImage):
+            entry.img.loader = self.__store.image_loader(record)
+        else:
+            entry.img = LazyImage(self.__store.image_loader(record), self.__store.image_shape(record), self.images)
+
+    # o vocabulário é guardado ao lado do índice (<ficheiro>.vocab); o inverted file é reconstruído
+    # a partir das palavras guardadas de cada entry. Se o vocabulário não for o que quantizou as entries
+    # (ex: ficheiro substituído), as palavras são calculadas de novo, só em memória: vários processos
+    # podem abrir a mesma base de dados ao mesmo tempo, por isso abrir nunca a compacta. As palavras
+    # novas só ficam em disco no próximo save()
+    def __load_vocabulary(self):
+        vocabulary = Vocabulary.load(self.filename + '.vocab')
+        if vocabulary is None:
+            return
+        if self.__store.meta.get('vocabulary') != vocabulary.id:
+            logger.info('Database %s was quantized with another vocabulary; recomputing the words in memory',
+                        self.filename)
+            for name, words in self.__words(vocabulary).items():
+                self.__entries[name].words = words
+            self.__store.meta['vocabulary'] = vocabulary.id
+        else:
+            for entry in self.__entries.values():
+                if entry.words is None:
+                    entry.words = vocabulary.quantize(entry.descriptors)
+        self.__inverted = InvertedFile.build(vocabulary, ((e.name, e.words) for e in self.__entries.values()))
+
+    # palavras visuais de cada entry, calculadas sem alterar as entries
+    def __words(self, vocabulary: Vocabulary, token: Optional[CancellationToken] = None,
+                progress: Optional[ProgressCallback] = None) -> Dict[str, np.ndarray]:
+        words = {}
+        for i, (name, entry) in enumerate(self.__entries.items()):
+            checkpoint(token, progress, 'quantize', i / len(self.__entries))
+            words[name] = vocabulary.quantize(entry.descriptors)
+        return words
+
+    def __quantize(self, vocabulary: Vocabulary, words: Dict[str, np.ndarray]):
+        for name, entry_words in words.items():
+            self.__entries[name].words = entry_words
+        self.__store.meta['vocabulary'] = vocabulary.id
+        self.save()
+
+    # treina um vocabulário visual com os descritores de todas as entries (operação offline, pode demorar)
+    # e passa a usá-lo para pré-selecionar os candidatos. As entries adicionadas depois são apenas
+    # quantizadas com o vocabulário existente. Com um token, o treino pode ser cancelado até a
+    # base de dados começar a ser alterada; até lá o vocabulário anterior continua em uso
+    def train_vocabulary(self, branching: int = BRANCHING, depth: int = DEPTH,
+                         token: Optional[CancellationToken] = None,
+                         progress: Optional[ProgressCallback] = None) -> Vocabulary:
+        if not self.__entries:
+            raise ValueError('Cannot train a vocabulary on an empty database')
+        descriptors = np.concatenate([e.descriptors for e in self.__entries.values()])
+        vocabulary = Vocabulary.train(descriptors, branching, depth, token=token, progress=progress)
+        words = self.__words(vocabulary, token, progress)
+        checkpoint(token, progress, 'save', 1.0)
+        vocabulary.save(self.filename + '.vocab')
+        self.__quantize(vocabulary, words)
+        self.__inverted = InvertedFile.build(vocabulary, ((e.name, e.words) for e in self.__entries.values()))
+        return vocabulary
+
+    @property
+    def vocabulary(self) -> Optional[Vocabulary]:
+        return self.__inverted.vocabulary if self.__inverted is not None else None
+
+    # cada alteração é apenas acrescentada aos ficheiros de dados e ao log; o índice é reescrito periodicamente
+    def __compact_if_needed(self):
+        if self.__store.needs_compaction:
+            self.save()
 
     # inserir Entry na database
     def add_entry(self, entry: Entry):
-        self.__entries[entry.name] = entry
-        self.save()
+        self.add_entries([entry])
+
+    # insere várias entries com uma única escrita (ex: importação em massa)
+    def add_entries(self, entries: Iterable[Entry]):
+        entries = list(entries)
+        if not entries:
+            return
+        for entry in entries:
+            replaced = self.__entries.get(entry.name)
+            if replaced is not None and replaced.group != entry.group:
+                self.__changed(replaced)
+            if self.__inverted is not None:
+                entry.words = self.__inverted.vocabulary.quantize(entry.descriptors)
+        records = self.__store.append_entries(entries)
+        for entry, record in zip(entries, records):
+            previous = self.__records.get(entry.name)
+            self.__records[entry.name] = record
+            if previous is not None:
+                self.__store.discard(previous)
+            self.__entries[entry.name] = entry
+            self.__load_image_from(entry, record)
+            if self.__inverted is not None:
+                self.__inverted.add(entry.name, entry.words)
+            self.__changed(entry)
+        self.__compact_if_needed()
 
     def remove_entry(self, entry: Entry):
-        if self.__entries[entry.name]:
+        if self.__entries.get(entry.name):
             del self.__entries[entry.name]
-            self.save()
+            if self.__inverted is not None:
+                self.__inverted.remove(entry.name)
+            self.__store.append_remove(self.__records.pop(entry.name))
+            self.__changed(entry)
+            self.__compact_if_needed()
 
-    # retornar o array de Entry
+    # retornar o array de Entry. É uma cópia, para que a GUI a possa percorrer enquanto a thread
+    # de fundo altera a base de dados
     @property
-    def entries(self):
-        return self.__entries.values()
+    def entries(self) -> List[Entry]:
+        return list(self.__entries.values())
 
     def entry(self, name) -> Optional[Entry]:
         return self.__entries.get(name)
+
+    # index global dos descritores de todas as entries, construído apenas quando é preciso
+    @property
+    def index(self) -> DescriptorIndex:
+        if self.__index is None:
+            self.__index = DescriptorIndex(self.__entries.values())
+        return self.__index
+
+    # grupos com pelo menos uma entry (None para as entries sem grupo)
+    @property
+    def groups(self) -> Set[Optional[str]]:
+        return {e.group or None for e in self.__entries.values()}
+
+    # index das entries de um grupo; é carregado (e guardado na cache de shards) apenas quando é pedido
+    def shard(self, group: Optional[str]) -> DescriptorIndex:
+        key = shard_key(group)
+        shard = self.__shards.get(key)
+        if shard is None:
+            shard = DescriptorIndex(e for e in self.__entries.values() if (e.group or None) == (group or None))
+            self.__shards.put(key, shard, shard.nbytes)
+        return shard
+
+    # descarrega os indexes de um grupo da memória (ficam em disco, se o backend o permitir)
+    def evict_shard(self, group: Optional[str]):
+        key = shard_key(group)
+        shard = self.__shards.get(key)
+        self.__shards.discard(key)
+        if shard is not None:
+            self.__shard_evicted(key, shard)
+
+    # compara os descritores da query uma única vez contra a base de dados inteira
+    # e retorna as entries mais votadas, juntamente com os seus good matches.
+    # Com um vocabulário treinado e uma base de dados grande, o inverted file pré-seleciona primeiro
+    # as `shortlist` entries mais parecidas e só essas são comparadas com o matcher.
+    # Se forem dados `groups`, só são procuradas as entries desses grupos, com o index de cada shard
+    def candidates(self, matcher, descriptors: np.ndarray, top: int = CANDIDATES, shortlist: int = SHORTLIST,
+                   groups: Optional[Iterable[Optional[str]]] = None) -> List[Tuple[Entry, List[DMatch]]]:
+        names = None
+        if groups is not None:
+            groups = {g or None for g in groups}
+            names = {e.name for e in self.__entries.values() if (e.group or None) in groups}
+        if self.__inverted is None or len(self.__entries if names is None else names) <= shortlist:
+            instrumentation.count('entries_scanned', len(self.__entries if names is None else names))
+            with instrumentation.span('vote'):
+                if names is None:
+                    voted = self.index.vote(matcher, descriptors, top=top)
+                else:
+                    voted = []
+                    for group in groups:
+                        voted.extend(self.shard(group).vote(matcher, descriptors, key=shard_key(group), top=top))
+                    voted.sort(key=lambda v: len(v[1]), reverse=True)
+            return [(self.__entries[name], matches) for name, matches in voted[:top]]
+        candidates = []
+        with instrumentation.span('inverted_file.query'):
+            shortlisted = self.__inverted.query(descriptors, shortlist, names)
+        instrumentation.count('entries_scanned', len(shortlisted))
+        for name, __ in shortlisted:
+            entry = self.__entries[name]
+            matches = matcher.match(entry.descriptors, descriptors, key=entry_key(name))
+            if len(matches) >= MIN_MATCH_COUNT:
+                candidates.append((entry, matches))
+        candidates.sort(key=lambda c: len(c[1]), reverse=True)
+        return candidates[:top]
+
@@ -0,0 +1,41 @@
+import threading
+from typing import Callable, List
+
+import numpy as np
+
+# função que recebe os resultados intermédios (descrição, imagem) para debug
+DebugListener = Callable[[str, np.ndarray], None]
+# função que cria a imagem de um resultado intermédio; só é chamada se alguém a for ver
+DebugProducer = Callable[[], np.ndarray]
+
+
+# Destino dos resultados intermédios do reconhecimento. As imagens de debug (key points desenhados,
+# composição dos matches, ...) são passadas como funções e só são criadas se houver subscritores no
+# momento em que são emitidas; sem subscritores (ou sem sink) não há nenhum custo de visualização
+class DebugSink:
+    def __init__(self):
+        self._listeners: List[DebugListener] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, listener: DebugListener):
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def unsubscribe(self, listener: DebugListener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    @property
+    def active(self) -> bool:
+        return bool(self._listeners)
+
+    def emit(self, text: str, producer: DebugProducer):
+        with self._lock:
+            listeners = list(self._listeners)
+        if not listeners:
+            return
+        image = producer()
+        for listener in listeners:
+            listener(text, image)
@@ -1,35 +1,97 @@
-from typing import Tuple
+from typing import List, Optional, Sequence, Tuple
 import cv2
 import numpy as np
 
+# Layout de um key point num array estruturado: é assim que as Entry guardam os seus key points,
+# todos num único bloco contíguo em vez de um objeto por key point
+KEY_POINT_DTYPE = np.dtype([
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('size', '<f4'),  # diâmetro da vizinhança do key point
+    ('angle', '<f4'),  # orientação do key point
+    ('response', '<f4'),  # response pela qual os key_points mais fortes foram selecionados. Pode ser usado para a posterior classificação ou subamostragem
+    ('octave', '<i4'),  # (pyramid layer) a partir do qual o key_point foi extraído
+    ('class_id', '<i4'),  # classe objeto (se os pontos de chave precisarem ser agrupados por um objeto ao qual pertencem)
+])
+
+
+# converte uma lista de cv2.KeyPoint num array estruturado com KEY_POINT_DTYPE
+def key_points_to_array(key_points: Sequence[cv2.KeyPoint]) -> np.ndarray:
+    return np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id)
+                     for kp in key_points], dtype=KEY_POINT_DTYPE)
+
+
+# operação inversa, usada apenas quando o OpenCV precisa de objetos cv2.KeyPoint (ex: drawMatches)
+def array_to_key_points(array: np.ndarray) -> List[cv2.KeyPoint]:
+    return [cv2.KeyPoint(float(r['x']), float(r['y']), float(r['size']), float(r['angle']),
+                         float(r['response']), int(r['octave']), int(r['class_id'])) for r in array]
+
+
+# vista (N, 2) das posições x,y de um array de key points, sem copiar dados
+def key_point_positions(array: np.ndarray) -> np.ndarray:
+    return array.view(np.float32).reshape(len(array), -1)[:, :2]
+
+
+# Escolha automática de `count` key points: os de maior resposta, mas distribuídos pela imagem.
+# A imagem é dividida numa grelha `grid` x `grid` e as células são percorridas em rondas, escolhendo
+# em cada ronda o melhor key point ainda livre de cada célula. Retorna os índices escolhidos
+def spread_key_points(array: np.ndarray, shape: Tuple[int, ...], count: int, grid: int = 8) -> np.ndarray:
+    if len(array) <= count:
+        return np.arange(len(array))
+    h, w = shape[:2]
+    rows = np.clip((array['y'] * grid / h).astype(np.int64), 0, grid - 1)
+    cols = np.clip((array['x'] * grid / w).astype(np.int64), 0, grid - 1)
+    cells = rows * grid + cols
+    # ordem por célula e, dentro de cada célula, por resposta decrescente
+    order = np.lexsort((-array['response'], cells))
+    sorted_cells = cells[order]
+    first = np.searchsorted(sorted_cells, sorted_cells, side='left')
+    rank = np.empty(len(array), dtype=np.int64)
+    rank[order] = np.arange(len(array)) - first
+    chosen = np.lexsort((-array['response'], rank))[:count]
+    return np.sort(chosen)
+
+
 # A Feature é a abstração escolhida para tratar os pontos chave da imagem
-#
+# Já não é usada para guardar as Entry; é criada apenas quando a GUI precisa de tratar features individualmente
 class Feature:
     def __init__(self, key_point: cv2.KeyPoint, descriptor: np.ndarray):
         self.descriptor: np.ndarray = descriptor
-        self._key_point: dict = {
-            'x': key_point.pt[0],
-            'y': key_point.pt[1],
-            'angle': key_point.angle, # orientação do key point
-            'response': key_point.response, # response pela qual os key_points mais fortes foram selecionados. Pode ser usado para a posterior classificação ou subamostragem
-            'octave': key_point.octave, # (pyramid layer) a partir do qual o key_point foi extraído
-            'class_id': key_point.class_id # classe objeto (se os pontos de chave precisarem ser agrupados por um objeto ao qual pertencem)
-        }
+        self.record: np.void = key_points_to_array([key_point])[0]
+
+    @classmethod
+    def from_record(cls, record: np.void, descriptor: np.ndarray) -> 'Feature':
+        feature = cls.__new__(cls)
+        feature.descriptor = descriptor
+        feature.record = record
+        return feature
+
+    # lista de Features a partir do resultado de detectAndCompute
+    @classmethod
+    def from_key_points(cls, key_points: Sequence[cv2.KeyPoint], descriptors: Optional[np.ndarray]) -> List['Feature']:
+        if descriptors is None:
+            return []
+        return [cls.from_record(r, d) for r, d in zip(key_points_to_array(key_points), descriptors)]
+
+    # compatibilidade com Features guardadas antes dos arrays estruturados (dict com 6 campos, sem size)
+    def __setstate__(self, state):
+        kp = state.pop('_key_point', None)
+        self.__dict__.update(state)
+        if kp is not None:
+            self.record = np.array([(kp['x'], kp['y'], 0, kp['angle'], kp['response'], kp['octave'], kp['class_id'])],
+                                   dtype=KEY_POINT_DTYPE)[0]
+
     # retorna o key_point
     @property
     def key_point(self) -> cv2.KeyPoint:
-        kp = self._key_point
-        return cv2.KeyPoint(kp['x'], kp['y'],
-                            kp['angle'],
-                            kp['response'],
-                            kp['octave'],
-                            kp['class_id'])
+        return array_to_key_points([self.record])[0]
 
     # retorna a orientação do key_point
     @property
     def angle(self) -> float:
-        return self.key_point.angle
+        return float(self.record['angle'])
+
     # retorna a posição x,y como tuplo
     @property
     def position(self) -> Tuple[float, float]:
-        return self.key_point.pt
+        return float(self.record['x']), float(self.record['y'])
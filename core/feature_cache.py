@@ -0,0 +1,123 @@
+import hashlib
+import io
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.feature import KEY_POINT_DTYPE, array_to_key_points, key_points_to_array
+from core.image import Image
+from log import logger
+
+# muda sempre que o formato dos ficheiros ou a forma de extrair as features mudar
+FEATURE_CACHE_VERSION = 1
+FEATURE_CACHE_BYTES = 512 * 1024 * 1024
+DEFAULT_FEATURE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rvau', 'features')
+
+
+# Cache em disco das features extraídas de uma imagem. A chave é um hash dos pixeis da imagem
+# e de todos os parâmetros que afetam a extração (backend, pré-processamento, resolução), por isso
+# a mesma imagem aberta de novo (na GUI ou num batch repetido) não volta a passar pelo detetor.
+# Cada entrada é um ficheiro .npz; o tamanho total é limitado e os ficheiros usados há mais tempo
+# (pela data de modificação, atualizada em cada leitura) são apagados primeiro.
+# Vários processos podem partilhar a mesma pasta: as escritas são atómicas e as remoções toleram
+# ficheiros que já desapareceram
+class FeatureCache:
+    def __init__(self, directory: str = DEFAULT_FEATURE_CACHE_DIR, max_bytes: int = FEATURE_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # estimativa do tamanho da pasta; só é calculada na primeira escrita
+        self._bytes: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image: Image, *params) -> str:
+        src = np.ascontiguousarray(image.src)
+        digest = hashlib.sha1(repr((FEATURE_CACHE_VERSION, cv2.__version__, src.shape, src.dtype.str) +
+                                   params).encode('utf-8'))
+        digest.update(src.data)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key: str) -> Optional[Tuple[List[cv2.KeyPoint], Optional[np.ndarray]]]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = np.load(io.BytesIO(file.read()), allow_pickle=False)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            logger.warning('Ignoring unreadable feature cache file %s: %s', path, error)
+            return None
+        key_points = data['key_points']
+        if key_points.dtype != KEY_POINT_DTYPE:
+            return None
+        descriptors = data['descriptors'] if 'descriptors' in data.files else None
+        return array_to_key_points(key_points), descriptors
+
+    def put(self, key: str, key_points: List[cv2.KeyPoint], descriptors: Optional[np.ndarray]):
+        arrays = {'key_points': key_points_to_array(key_points)}
+        if descriptors is not None:
+            arrays['descriptors'] = descriptors
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        data = buffer.getvalue()
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp = os.path.join(self.directory, 'tmp-%d-%d-%s' % (os.getpid(), threading.get_ident(), key))
+        with open(tmp, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan()[1]
+            else:
+                self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    # lista (tempo de acesso, tamanho, caminho) dos ficheiros da cache e o tamanho total
+    def _scan(self) -> Tuple[List[Tuple[float, int, str]], int]:
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files, sum(size for __, size, __ in files)
+
+    # a pasta pode ter sido alterada por outros processos, por isso é lida de novo antes de apagar
+    def _evict(self):
+        files, total = self._scan()
+        files.sort()
+        removed = 0
+        for __, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._bytes = total
+        logger.debug('Evicted %d feature cache files (%d bytes left)', removed, total)
+
+    def clear(self):
+        with self._lock:
+            for __, __, path in self._scan()[0] if os.path.isdir(self.directory) else []:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._bytes = 0
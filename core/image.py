@@ -1,7 +1,16 @@
+import itertools
+from typing import Callable, Tuple
+
 import cv2
 import os
 import numpy as np
 
+from core.cache import LRUCache
+
+# orçamento por omissão da cache de imagens descodificadas das entries
+IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+
+
 # classe para tratar a imagem
 class Image:
     def __init__(self, data):
@@ -30,4 +39,48 @@ class Image:
     def rgb(self):
         if self.__rgb is None:
             self.__rgb = cv2.cvtColor(self.src, cv2.COLOR_BGR2RGB)
-        return self.__rgb
\ No newline at end of file
+        return self.__rgb
+
+
+# Imagem de uma entry guardada na base de dados: só é descodificada quando os pixeis são acedidos.
+# As versões descodificadas (e as conversões grayscale/rgb) ficam numa cache LRU partilhada, por isso
+# podem ser descartadas e voltar a ser descodificadas mais tarde. As dimensões vêm dos metadados
+# e nunca obrigam a descodificar a imagem
+class LazyImage(Image):
+    __tokens = itertools.count()
+
+    def __init__(self, loader: Callable[[], bytes], shape: Tuple[int, ...], cache: LRUCache):
+        self.loader = loader
+        self.shape = tuple(shape)
+        self.cache = cache
+        self._token = next(LazyImage.__tokens)
+
+    # a imagem comprimida, tal como está guardada
+    @property
+    def encoded(self) -> bytes:
+        return self.loader()
+
+    @property
+    def src(self):
+        return self._cached('src', lambda: cv2.imdecode(np.frombuffer(self.loader(), dtype=np.uint8),
+                                                        cv2.IMREAD_UNCHANGED))
+
+    @property
+    def dimensions(self):
+        return self.shape
+
+    @property
+    def grayscale(self):
+        return self._cached('grayscale', lambda: cv2.cvtColor(self.src, cv2.COLOR_BGR2GRAY))
+
+    @property
+    def rgb(self):
+        return self._cached('rgb', lambda: cv2.cvtColor(self.src, cv2.COLOR_BGR2RGB))
+
+    def _cached(self, kind: str, make: Callable[[], np.ndarray]) -> np.ndarray:
+        key = (self._token, kind)
+        value = self.cache.get(key)
+        if value is None:
+            value = make()
+            self.cache.put(key, value)
+        return value
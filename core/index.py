@@ -0,0 +1,99 @@
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.matcher import Matcher, MIN_MATCH_COUNT
+
+# o database.py importa este módulo, por isso a Entry só é importada para as anotações
+if TYPE_CHECKING:
+    from core.database import Entry
+
+# número de entries mais votadas que seguem para a verificação com homografia
+CANDIDATES = 5
+# chave do index global na cache de indexes do Matcher
+INDEX_KEY = 'index'
+# memória máxima ocupada pelos indexes dos grupos carregados (ver Database.shard)
+SHARD_CACHE_BYTES = 512 * 1024 * 1024
+# vizinhos pedidos ao kNN do index global para encontrar o mais próximo de outra entry (ver vote)
+VOTE_NEIGHBOURS = 8
+
+
+# chave do index de uma única entry na cache de indexes do Matcher
+def entry_key(name: str) -> str:
+    return 'entry:' + name
+
+
+# chave do index de um grupo (shard) na cache de indexes do Matcher; as entries sem grupo formam um shard próprio
+def shard_key(group: Optional[str]) -> str:
+    return 'shard:' + group if group else 'shard'
+
+
+# Index global com os descritores de todas as Entry empilhados numa única matriz.
+# Cada linha da matriz tem uma entrada na tabela `lookup` com o par (entry, feature)
+# de onde veio, para que uma query seja comparada uma única vez contra toda a base de dados
+class DescriptorIndex:
+    def __init__(self, entries: Iterable['Entry']):
+        self.names: List[str] = []
+        blocks, owners, features = [], [], []
+        for i, entry in enumerate(entries):
+            des = entry.descriptors
+            self.names.append(entry.name)
+            blocks.append(des)
+            owners.append(np.full(len(des), i, dtype=np.int32))
+            features.append(np.arange(len(des), dtype=np.int32))
+        if blocks:
+            self.descriptors = np.ascontiguousarray(np.vstack(blocks))
+            self.lookup = np.column_stack((np.concatenate(owners), np.concatenate(features)))
+        else:
+            self.descriptors = np.empty((0, 128), dtype=np.float32)
+            self.lookup = np.empty((0, 2), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    # memória ocupada pelo index, para a cache de shards
+    @property
+    def nbytes(self) -> int:
+        return self.descriptors.nbytes + self.lookup.nbytes
+
+    # Faz o kNN da query contra o index inteiro e conta os good matches por entry.
+    # O ratio test é feito por entry, como no matching de cada entry em separado: o vizinho mais próximo
+    # de uma entry é comparado com o segundo vizinho dessa mesma entry, para que entries repetidas ou
+    # quase iguais não anulem os votos umas das outras. Se a entry não tiver outro vizinho entre os
+    # `neighbours` pedidos, o último serve de limite inferior para a distância do segundo.
+    # Retorna as `top` entries mais votadas (com pelo menos `min_votes`), ordenadas por votos.
+    # Os matches seguem a convenção de Matcher.match: queryIdx -> feature da entry, trainIdx -> keypoint da query
+    def vote(self, matcher: Matcher, des: np.ndarray, key: str = INDEX_KEY,
+             min_votes: int = MIN_MATCH_COUNT, top: int = CANDIDATES,
+             neighbours: int = VOTE_NEIGHBOURS) -> List[Tuple[str, List[cv2.DMatch]]]:
+        if des is None or len(des) == 0 or len(self) < 2:
+            return []
+        k = max(2, min(neighbours, len(self)))
+        indices, distances = matcher.knn_search(self.descriptors, des, key=key, k=k)
+        found = indices >= 0
+        owners = np.where(found, self.lookup[np.where(found, indices, 0), 0], -1)
+        # para cada vizinho: é o primeiro da sua entry? e qual a coluna do segundo vizinho da mesma entry?
+        first = found.copy()
+        second = np.full(indices.shape, k - 1)
+        for j in range(1, k):
+            same = owners[:, :j] == owners[:, j:j + 1]
+            first[:, j] &= ~same.any(axis=1)
+            earlier = same & (second[:, :j] == k - 1) & first[:, :j]
+            second[:, :j][earlier] = j
+        rows = np.arange(len(indices))[:, None]
+        pairs = np.stack((np.where(first, indices, -1), indices[rows, second]), axis=-1).reshape(-1, 2)
+        pair_distances = np.stack((distances, distances[rows, second]), axis=-1).reshape(-1, 2)
+        good = np.flatnonzero(matcher.ratio_test(pairs, pair_distances))
+        queries, columns = good // k, good % k
+        owners, features = self.lookup[indices[queries, columns]].T
+        distances = matcher.backend.distance(distances[queries, columns].astype(np.float32))
+        votes = np.bincount(owners, minlength=len(self.names))
+        ranked = [owner for owner in np.argsort(-votes, kind='stable')[:top] if votes[owner] >= min_votes]
+        result = []
+        for owner in ranked:
+            mine = owners == owner
+            matches = [cv2.DMatch(int(f), int(q), float(d))
+                       for f, q, d in zip(features[mine], queries[mine], distances[mine])]
+            result.append((self.names[owner], matches))
+        return result
@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Callable, Dict, List, Optional
+
+# Instrumentação leve: spans (duração de uma etapa, com um context manager) e contadores (key points,
+# good matches, inliers, entries percorridas, ...). Está desligada por omissão; nesse caso span()
+# retorna sempre o mesmo objeto que não faz nada e count() retorna logo, por isso o custo é uma
+# verificação de uma variável global por chamada
+
+# função que recebe cada evento (ver record) quando a instrumentação está ligada
+Exporter = Callable[[dict], None]
+
+PROMETHEUS_PREFIX = 'rvau'
+
+_enabled = False
+_lock = threading.Lock()
+# nome do span -> [número de amostras, total, mínimo, máximo, último] em segundos
+_spans: Dict[str, List[float]] = {}
+_counters: Dict[str, float] = {}
+_exporters: List[Exporter] = []
+
+
+def enable(enabled: bool = True):
+    global _enabled
+    _enabled = enabled
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record({'type': 'span', 'name': self.name, 'value': time.perf_counter() - self.start})
+        return False
+
+
+# with span('flann.knn'): ... mede a duração do bloco
+def span(name: str):
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def count(name: str, value: float = 1):
+    if _enabled:
+        record({'type': 'counter', 'name': name, 'value': value})
+
+
+# acumula um evento {'type': 'span' | 'counter', 'name': ..., 'value': ...} e passa-o aos exporters.
+# Também serve para juntar eventos medidos noutro processo (ver recognize.py)
+def record(event: dict):
+    name, value = event['name'], event['value']
+    event.setdefault('time', time.time())
+    event.setdefault('pid', os.getpid())
+    with _lock:
+        if event['type'] == 'span':
+            stats = _spans.get(name)
+            if stats is None:
+                _spans[name] = [1, value, value, value, value]
+            else:
+                stats[0] += 1
+                stats[1] += value
+                stats[2] = min(stats[2], value)
+                stats[3] = max(stats[3], value)
+                stats[4] = value
+        else:
+            _counters[name] = _counters.get(name, 0) + value
+        exporters = list(_exporters)
+    for exporter in exporters:
+        exporter(event)
+
+
+def add_exporter(exporter: Exporter):
+    with _lock:
+        _exporters.append(exporter)
+
+
+def remove_exporter(exporter: Exporter):
+    with _lock:
+        if exporter in _exporters:
+            _exporters.remove(exporter)
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+# cópia dos valores acumulados: {'spans': {nome: {...}}, 'counters': {nome: valor}}
+def snapshot() -> dict:
+    with _lock:
+        spans = {name: {'count': int(stats[0]), 'total_s': stats[1], 'mean_s': stats[1] / stats[0],
+                        'min_s': stats[2], 'max_s': stats[3], 'last_s': stats[4]}
+                 for name, stats in _spans.items()}
+        return {'spans': spans, 'counters': dict(_counters)}
+
+
+# Escreve cada evento como uma linha JSON (para execuções sem GUI)
+class JsonLinesExporter:
+    def __init__(self, filename: str):
+        self._file = open(filename, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, event: dict):
+        line = json.dumps(event) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _metric_name(name: str) -> str:
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# valores acumulados no formato de texto do Prometheus
+def prometheus_text(values: Optional[dict] = None) -> str:
+    values = values if values is not None else snapshot()
+    lines = []
+    if values['spans']:
+        for metric, field, kind in (('span_seconds_count', 'count', 'counter'),
+                                    ('span_seconds_sum', 'total_s', 'counter'),
+                                    ('span_seconds_max', 'max_s', 'gauge')):
+            lines.append('# TYPE %s_%s %s' % (PROMETHEUS_PREFIX, metric, kind))
+            for name, stats in sorted(values['spans'].items()):
+                lines.append('%s_%s{span="%s"} %r' % (PROMETHEUS_PREFIX, metric, _label(name), float(stats[field])))
+    for name, value in sorted(values['counters'].items()):
+        metric = '%s_%s_total' % (PROMETHEUS_PREFIX, _metric_name(name))
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %r' % (metric, float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# serve os valores acumulados em http://<host>:<port>/ numa thread de fundo
+def serve_prometheus(port: int, host: str = '') -> HTTPServer:
+    server = HTTPServer((host, port), _PrometheusHandler)
+    thread = threading.Thread(target=server.serve_forever, name='prometheus', daemon=True)
+    thread.start()
+    return server
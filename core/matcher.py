@@ -1,68 +1,218 @@
-from typing import Tuple, List
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Tuple, List, Optional
 
 import cv2
 import numpy as np
 
+from core import instrumentation
+from core.backends import Backend, DEFAULT_BACKEND, backend as get_backend
+from core.cancellation import CancellationToken, ProgressCallback, checkpoint
+from core.debug import DebugSink
 from core.feature import Feature
+from core.feature_cache import FeatureCache
 from core.image import Image
+from core.preprocessing import DEFAULT_PREPROCESSING, HIGH_PASS_RADIUS, Clahe, HighPass, Laplacian, Preprocessing
+from core.resolution import FULL_RESOLUTION, ResolutionPolicy
+from log import logger
 
-FLANN_INDEX_KDTREE = 1
-FLANN_INDEX_LSH = 6
 MIN_MATCH_COUNT = 10
+INDEX_CACHE_SIZE = 64
+
+_CLAHE = Clahe()
 
 
 class Matcher:
-    def __init__(self):
-        # self._orb = cv2.ORB_create(nfeatures=1000)
-        # self._surf = cv2.xfeatures2d.SURF_create(300)
-        self._sift = cv2.xfeatures2d.SIFT_create()
+    def __init__(self, backend: str = DEFAULT_BACKEND, cache_size: int = INDEX_CACHE_SIZE,
+                 feature_cache: Optional[FeatureCache] = None, preprocessing: Optional[Preprocessing] = None):
+        # o detector/descritor é escolhido por base de dados (ver backends.py)
+        self.backend: Backend = get_backend(backend)
+        self._detector = self.backend.create()
+        self.feature_cache = feature_cache
+        # etapas aplicadas às imagens antes da deteção; ao ligar o matcher a uma base de dados passam a
+        # ser as dessa base de dados
+        self.preprocessing: Preprocessing = preprocessing or DEFAULT_PREPROCESSING
+        # cache LRU de indexes FLANN já treinados, indexados por uma chave (ex: a entry a que pertencem)
+        self.cache_size = cache_size
+        self._indexes: OrderedDict = OrderedDict()
+        self._index_dir: Optional[str] = None
 
     def features_raw(self, img: Image) -> Tuple[List[cv2.KeyPoint], np.ndarray]:
-        return self._sift.detectAndCompute(img.src, None) # retorna os keypoints e os descriptors da imagem
+        return self._detector.detectAndCompute(img.src, None) # retorna os keypoints e os descriptors da imagem
 
     # transforma os keypoints e os descriptors da retornados pela função anterior numa lista de Feature para permitir o tratamento de maneira mais detalhada
     def features(self, img: Image) -> List[Feature]:
-        key_points, descriptors = self.features_raw(img)
-        final = []
-        for kp, des in zip(key_points, descriptors):
-            final.append(Feature(kp, des))
-        return final
-
-    def match(self, src_des: np.ndarray, target_des: np.ndarray):
-        # index_params = dict(algorithm=FLANN_INDEX_LSH)
-        # search_params = dict(checks=50)
-        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+        return Feature.from_key_points(*self.features_raw(img))
+
+    def preprocess(self, image: Image) -> Image:
+        return self.preprocessing.apply(image)
+
+    # Extração completa das features de uma imagem: redução segundo a política de resolução, preprocessamento,
+    # deteção e key points de volta às coordenadas da imagem original. Com uma cache de features, uma
+    # imagem já vista não passa por nenhuma destas etapas (exceto se alguém estiver a ver o debug, que
+    # precisa das imagens intermédias). O cancelamento é verificado entre etapas
+    # com um `token` a extração pode ser cancelada entre etapas, e `progress` é chamado no início de cada uma
+    def extract(self, image: Image, resolution: ResolutionPolicy = FULL_RESOLUTION,
+                debug: Optional[DebugSink] = None,
+                token: Optional[CancellationToken] = None,
+                progress: Optional[ProgressCallback] = None) -> Tuple[List[cv2.KeyPoint], np.ndarray]:
+        if debug is not None and not debug.active:
+            debug = None
+        key = None
+        if self.feature_cache is not None:
+            key = self.feature_cache.key(image, self.backend.signature, self.preprocessing.signature,
+                                         resolution.max_edge, resolution.max_key_points)
+            cached = self.feature_cache.get(key) if debug is None else None
+            if cached is not None:
+                instrumentation.count('feature_cache.hits')
+                return cached
+            instrumentation.count('feature_cache.misses')
+        checkpoint(token, progress, 'resize', 0.0)
+        with instrumentation.span('resize'):
+            small, factor = resolution.resize(image)
+        checkpoint(token, progress, 'preprocess', 0.1)
+        with instrumentation.span('preprocess'):
+            image_eq = self.preprocess(small)
+        if debug is not None:
+            debug.emit("Loaded imagem in grayscale", lambda: image.grayscale)
+            debug.emit("Preprocessed image (%s)" % self.preprocessing, lambda: image_eq.src)
+        checkpoint(token, progress, 'detect', 0.2)
+        with instrumentation.span('detect'):
+            kp, des = resolution.limit(*self.features_raw(image_eq))
+        instrumentation.count('key_points', len(kp))
+        checkpoint(token, progress, 'done (%d key points)' % len(kp), 1.0)
+        if debug is not None:
+            debug.emit("Features in equalized image", lambda: Image(cv2.drawKeypoints(image_eq.src, kp, None)).rgb)
+        kp = resolution.restore(kp, factor)
+        if key is not None:
+            self.feature_cache.put(key, kp, des)
+        return kp, des
+
+    # liga o matcher a uma base de dados: os indexes são guardados ao lado do ficheiro da base de dados
+    # e são invalidados sempre que uma entry é adicionada ou removida
+    def attach(self, database):
+        if database.backend != self.backend.name:
+            raise ValueError("Database %s was built with the '%s' backend, not '%s'"
+                             % (database.filename, database.backend, self.backend.name))
+        self._index_dir = database.filename + '.flann'
+        self.preprocessing = database.preprocessing
+        database.subscribe(self.invalidate, on_evict=self.evict)
+
+    def invalidate(self, key: str):
+        self._indexes.pop(key, None)
+        self._remove_index_files(key)
+
+    # liberta o index da memória mas mantém-no em disco, para ser carregado de novo quando for preciso
+    def evict(self, key: str):
+        self._indexes.pop(key, None)
+
+    # apaga os indexes guardados para uma chave, exceto `keep`
+    def _remove_index_files(self, key: str, keep: Optional[str] = None):
+        if self._index_dir is None or not os.path.isdir(self._index_dir):
+            return
+        prefix = self._key_hash(key) + '.'
+        for filename in os.listdir(self._index_dir):
+            path = os.path.join(self._index_dir, filename)
+            if filename.startswith(prefix) and path != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    # retorna o index FLANN treinado com `train_des`, construindo-o apenas se não estiver em memória nem em disco.
+    # Um index em memória só é reutilizado se tiver sido construído com o mesmo array: sem attach() o Matcher
+    # não é avisado das alterações da base de dados, e a chave passa a corresponder a outros descritores
+    def index(self, key: str, train_des: np.ndarray) -> cv2.flann_Index:
+        cached = self._indexes.get(key)
+        if cached is not None and cached[1] is train_des:
+            self._indexes.move_to_end(key)
+            return cached[0]
+        index = self._load_index(key, train_des)
+        if index is None:
+            index = self._build_index(train_des)
+            self._save_index(key, train_des, index)
+        # o index FLANN não é dono dos descritores, por isso guardamos uma referência para eles
+        self._indexes[key] = (index, train_des)
+        while len(self._indexes) > self.cache_size:
+            self._indexes.popitem(last=False)
+        return index
+
+    def _build_index(self, train_des: np.ndarray) -> cv2.flann_Index:
+        with instrumentation.span('flann.build'):
+            return cv2.flann_Index(train_des, self.backend.index_params())
+
+    @staticmethod
+    def _key_hash(key: str) -> str:
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    # o nome do ficheiro inclui uma impressão digital dos descritores (forma, tipo e conteúdo) para nunca
+    # carregar um index desatualizado
+    def _index_path(self, key: str, train_des: np.ndarray) -> Optional[str]:
+        if self._index_dir is None or not self.backend.persistent_index:
+            return None
+        digest = hashlib.sha1(('%s%s' % (train_des.shape, train_des.dtype.str)).encode('ascii'))
+        digest.update(np.ascontiguousarray(train_des).data)
+        fingerprint = digest.hexdigest()[:16]
+        return os.path.join(self._index_dir, '%s.%s.idx' % (self._key_hash(key), fingerprint))
+
+    def _load_index(self, key: str, train_des: np.ndarray) -> Optional[cv2.flann_Index]:
+        path = self._index_path(key, train_des)
+        if path is None or not os.path.exists(path):
+            return None
+        index = cv2.flann_Index()
+        if not index.load(train_des, path):
+            logger.warning('Could not load cached index: %s', path)
+            return None
+        return index
+
+    def _save_index(self, key: str, train_des: np.ndarray, index: cv2.flann_Index):
+        path = self._index_path(key, train_des)
+        if path is None:
+            return
+        os.makedirs(self._index_dir, exist_ok=True)
+        # vários processos podem partilhar a mesma base de dados, por isso o index é escrito num ficheiro
+        # temporário e só depois colocado no sítio
+        tmp = os.path.join(self._index_dir, 'tmp-%d-%s' % (os.getpid(), os.path.basename(path)))
+        index.save(tmp)
+        os.replace(tmp, path)
+        self._remove_index_files(key, keep=path)
+
+    # kNN dos descritores `query_des` contra `train_des`; retorna os arrays (índices, distâncias) de tamanho (N, k).
+    # Se for dada uma chave, o index de `train_des` é reutilizado entre chamadas
+    def knn_search(self, train_des: np.ndarray, query_des: np.ndarray, key: Optional[str] = None,
+                   k=2) -> Tuple[np.ndarray, np.ndarray]:
         search_params = dict(checks=50)
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-        matches = flann.knnMatch(src_des, target_des, k=2)
-        # store all the good matches as per Lowe's ratio test.
-        good = []
-        for m, n in matches:
-            if m.distance < 0.7 * n.distance:
-                good.append(m)
-        return good
+        index = self._build_index(train_des) if key is None else self.index(key, train_des)
+        with instrumentation.span('flann.knn'):
+            return index.knnSearch(query_des, k, params=search_params)
+
+    # máscara dos good matches de um kNN com k=2 (ver Backend.ratio_test)
+    def ratio_test(self, indices: np.ndarray, distances: np.ndarray) -> np.ndarray:
+        with instrumentation.span('ratio_test'):
+            mask = self.backend.ratio_test(indices, distances)
+        instrumentation.count('good_matches', int(np.count_nonzero(mask)))
+        return mask
+
+    # retorna os good matches entre os descritores de uma entry (src) e os de uma imagem (target).
+    # queryIdx refere-se a src e trainIdx a target
+    def match(self, src_des: np.ndarray, target_des: np.ndarray, key: Optional[str] = None) -> List[cv2.DMatch]:
+        if len(src_des) < 2 or target_des is None or len(target_des) == 0:
+            return []
+        indices, distances = self.knn_search(src_des, target_des, key=key)
+        good = np.flatnonzero(self.ratio_test(indices, distances))
+        distances = self.backend.distance(distances[good, 0].astype(np.float32))
+        return [cv2.DMatch(int(indices[i, 0]), int(i), float(d)) for i, d in zip(good, distances)]
 
+    # as etapas antigas, agora implementadas em preprocessing.py
     @staticmethod
-    def highpass_filter(image: Image, freq=10) -> Image:
-        f = np.fft.fft2(image.src)
-        f_shift = np.fft.fftshift(f)
-        rows, cols = image.dimensions
-        crow, ccol = int(rows / 2), int(cols / 2)
-        f_shift[crow - freq:crow + freq, ccol - freq:ccol + freq] = 0
-        f_ishift = np.fft.ifftshift(f_shift)
-        img_back = np.fft.ifft2(f_ishift)
-        img_back = np.abs(img_back)
-        return Image(np.uint8(img_back))
+    def highpass_filter(image: Image, freq=HIGH_PASS_RADIUS) -> Image:
+        return Image(HighPass(freq)(image.src))
 
     @staticmethod
     def laplacian_gradient(image: Image):
-        tmp = cv2.Laplacian(image.src, cv2.CV_64F)
-        tmp = np.absolute(tmp)
-        return Image(np.uint8(tmp))
+        return Image(Laplacian()(image.src))
 
     @staticmethod
     def histogram_equalization(img: Image) -> Image:
-        # create a CLAHE object (Arguments are optional).
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(2, 2))
-        equalized = clahe.apply(img.grayscale)
-        return Image(equalized)
+        return Image(_CLAHE(img.src))
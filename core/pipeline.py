@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core import instrumentation
+from core.debug import DebugSink
+from core.cancellation import CancellationToken, ProgressCallback, checkpoint
+from core.database import Database, Entry
+from core.image import Image
+from core.index import CANDIDATES
+from core.matcher import Matcher
+from core.resolution import DEFAULT_RESOLUTION, ResolutionPolicy
+from log import logger
+
+# função chamada durante a verificação sempre que aparece um candidato melhor (entry, inliers)
+CandidateCallback = Callable[[Entry, int], None]
+
+# threads usadas para calcular as homografias dos candidatos em paralelo (o OpenCV liberta o GIL).
+# São menos do que os candidatos, para que um vencedor claro evite as homografias dos restantes
+VERIFY_THREADS = max(1, min(CANDIDATES // 2, os.cpu_count() or 1))
+# intervalo (em segundos) com que o cancelamento é verificado enquanto se espera pelas homografias
+CANCEL_POLL = 0.05
+
+_verify_pool: Optional[ThreadPoolExecutor] = None
+_verify_pool_lock = threading.Lock()
+
+
+def verify_pool() -> ThreadPoolExecutor:
+    global _verify_pool
+    with _verify_pool_lock:
+        if _verify_pool is None:
+            _verify_pool = ThreadPoolExecutor(VERIFY_THREADS, thread_name_prefix='verify')
+        return _verify_pool
+
+
+# Resultado do reconhecimento de uma imagem, independente da GUI
+class RecognitionResult:
+    def __init__(self):
+        self.entry: Optional[Entry] = None
+        self.homography: Optional[np.ndarray] = None
+        self.inliers: int = 0
+        self.matches: List[cv2.DMatch] = []
+        self.matches_mask: List[int] = []
+        self.key_points: List[cv2.KeyPoint] = []
+        self.candidates: int = 0
+        # duração de cada etapa em segundos, pela ordem em que foram executadas
+        self.timings: Dict[str, float] = {}
+
+    @property
+    def matched(self) -> bool:
+        return self.entry is not None
+
+    # versão serializável em JSON
+    def to_dict(self) -> dict:
+        return {'entry': self.entry.name if self.entry is not None else None,
+                'group': self.entry.group if self.entry is not None else None,
+                'homography': self.homography.tolist() if self.homography is not None else None,
+                'inliers': self.inliers,
+                'matches': len(self.matches),
+                'key_points': len(self.key_points),
+                'candidates': self.candidates,
+                'timings': self.timings}
+
+
+# homografia da entry para a imagem de query, estimada com RANSAC a partir dos matches
+def homography(entry: Entry, matches: List[cv2.DMatch],
+               key_points: List[cv2.KeyPoint]) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    src_pts = entry.points[[m.queryIdx for m in matches]].reshape(-1, 1, 2)
+    dst_pts = np.float32([key_points[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+    with instrumentation.span('find_homography'):
+        return cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+
+
+# Verificação geométrica dos candidatos: as homografias são calculadas em paralelo e o melhor
+# candidato é o que tem mais inliers (em caso de empate, o que vem primeiro em `candidates`).
+# Os candidatos são submetidos pela ordem dos votos, no máximo VERIFY_THREADS de cada vez. Um candidato
+# nunca tem mais inliers do que matches, por isso quando o próximo já não pode bater o melhor (nem nenhum
+# dos seguintes, que têm menos votos) não é submetido mais nenhum. Retorna (entry, matches, homografia,
+# máscara) ou None
+def verify(candidates: List[Tuple[Entry, List[cv2.DMatch]]], key_points: List[cv2.KeyPoint],
+           token: Optional[CancellationToken] = None,
+           progress: Optional[ProgressCallback] = None,
+           on_candidate: Optional[CandidateCallback] = None) -> Optional[tuple]:
+    if not candidates:
+        return None
+    pool = verify_pool()
+    # os candidatos vêm ordenados pelos votos (número de matches)
+    order = sorted(range(len(candidates)), key=lambda rank: (-len(candidates[rank][1]), rank))
+    futures: Dict[Future, int] = {}
+    pending = set()
+    best, best_rank, best_inliers = None, -1, -1
+
+    def can_win(rank: int) -> bool:
+        votes = len(candidates[rank][1])
+        return best is None or votes > best_inliers or votes == best_inliers and rank < best_rank
+
+    try:
+        while True:
+            while order and len(pending) < VERIFY_THREADS and can_win(order[0]):
+                rank = order.pop(0)
+                entry, matches = candidates[rank]
+                future = pool.submit(homography, entry, matches, key_points)
+                futures[future] = rank
+                pending.add(future)
+            if not order or not can_win(order[0]):
+                # os que já estão a ser verificados e não podem ganhar também são abandonados
+                pending = {f for f in pending if can_win(futures[f])}
+            if not pending:
+                break
+            done, pending = wait(pending, CANCEL_POLL, FIRST_COMPLETED)
+            verified = len(futures) - len(pending)
+            checkpoint(token, progress, 'homography (%d/%d candidates)' % (verified, len(candidates)),
+                       0.8 + 0.2 * verified / len(candidates))
+            for future in done:
+                rank = futures[future]
+                entry, matches = candidates[rank]
+                matrix, mask = future.result()
+                inliers = int(mask.sum()) if matrix is not None else 0
+                logger.debug("Entry '%s' got %d votes and %d inliers", entry.name, len(matches), inliers)
+                instrumentation.count('candidates_verified')
+                if matrix is not None and (inliers > best_inliers or inliers == best_inliers and rank < best_rank):
+                    best, best_rank, best_inliers = (entry, matches, matrix, mask), rank, inliers
+                    if on_candidate is not None:
+                        on_candidate(entry, inliers)
+        skipped = len(candidates) - len(futures)
+        if skipped:
+            instrumentation.count('candidates_skipped', skipped)
+            logger.debug('Skipping %d candidates that cannot beat %d inliers', skipped, best_inliers)
+    finally:
+        for future in pending:
+            future.cancel()
+    return best
+
+
+class _Stopwatch:
+    def __init__(self, timings: Dict[str, float], stage: str):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.timings[self.stage] = elapsed
+        if instrumentation.enabled():
+            instrumentation.record({'type': 'span', 'name': 'recognize.' + self.stage, 'value': elapsed})
+
+
+# composição da entry e da imagem de query (com o contorno da entry projetado) com os matches
+def draw_matches(image: Image, result: RecognitionResult) -> np.ndarray:
+    entry = result.entry
+    h, w = entry.img.dimensions[:2]
+    pts = np.float32([[0, 0], [0, h - 1], [w - 1, h - 1], [w - 1, 0]]).reshape(-1, 1, 2)
+    dst = cv2.perspectiveTransform(pts, result.homography)
+    img_with_box = Image(cv2.polylines(np.copy(image.src), [np.int32(dst)], True, 255, 3, cv2.LINE_AA))
+    match_res_img = Image(
+        cv2.drawMatches(entry.img.src, entry.key_points, img_with_box.src, result.key_points, result.matches,
+                        None,
+                        matchesMask=result.matches_mask,
+                        flags=2, matchColor=(0, 255, 0),
+                        singlePointColor=False))
+    return match_res_img.rgb
+
+
+# Reconhece uma imagem: equalização, extração de features, matching contra a base de dados e verificação
+# geométrica dos candidatos (ver verify).
+# É a lógica que antes estava em MainWindow.open_image, sem depender do Qt.
+# `groups` restringe a procura às entries desses grupos (ver Database.candidates).
+# As features são detetadas na resolução dada por `resolution`, mas os key points do resultado
+# estão sempre nas coordenadas da imagem original.
+# Com um `token`, o reconhecimento pode ser cancelado entre etapas (lança Cancelled); `progress`
+# é chamado no início de cada etapa e `on_candidate` com o melhor candidato encontrado até ao momento
+def recognize(image: Image, database: Database, matcher: Matcher, debug: Optional[DebugSink] = None,
+              groups: Optional[Iterable[Optional[str]]] = None,
+              resolution: ResolutionPolicy = DEFAULT_RESOLUTION,
+              token: Optional[CancellationToken] = None,
+              progress: Optional[ProgressCallback] = None,
+              on_candidate: Optional[CandidateCallback] = None) -> RecognitionResult:
+    result = RecognitionResult()
+    timings = result.timings
+    instrumentation.count('recognitions')
+    checkpoint(token, progress, 'features', 0.0)
+    with _Stopwatch(timings, 'features'):
+        kp, des = matcher.extract(image, resolution, debug, token)
+    result.key_points = kp
+    checkpoint(token, progress, 'match (%d key points)' % len(kp), 0.5)
+    with _Stopwatch(timings, 'match'):
+        candidates = database.candidates(matcher, des, groups=groups)
+    result.candidates = len(candidates)
+    checkpoint(token, progress, 'homography (%d candidates)' % len(candidates), 0.8)
+    with _Stopwatch(timings, 'homography'):
+        best = verify(candidates, kp, token, progress, on_candidate)
+    if best is not None:
+        entry, matches, matrix, mask = best
+        logger.info("Found a match in the database! (%s)", entry.name)
+        result.entry = entry
+        result.homography = matrix
+        result.matches = matches
+        result.matches_mask = mask.ravel().tolist()
+        result.inliers = int(mask.sum())
+        instrumentation.count('inliers', result.inliers)
+        instrumentation.count('matched')
+    if debug is not None and result.matched:
+        debug.emit("Matching result with homography", lambda: draw_matches(image, result))
+    if progress is not None:
+        progress('done', 1.0)
+    return result
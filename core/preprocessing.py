@@ -0,0 +1,154 @@
+import functools
+import json
+import threading
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+from core.image import Image
+
+CLAHE_CLIP_LIMIT = 2.0
+CLAHE_TILE_GRID = (2, 2)
+HIGH_PASS_RADIUS = 10
+
+# preprocessamento com que as features sempre foram extraídas: grayscale e CLAHE
+DEFAULT_PREPROCESSING_CONFIG = [{'type': 'grayscale'},
+                                {'type': 'clahe', 'clip_limit': CLAHE_CLIP_LIMIT, 'tile_grid': list(CLAHE_TILE_GRID)}]
+
+
+def _gray(src: np.ndarray) -> np.ndarray:
+    return src if src.ndim == 2 else cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
+
+
+# Etapa do preprocessamento: recebe e retorna um array com a imagem. As etapas são reutilizadas entre
+# chamadas (objetos do OpenCV, máscaras, buffers auxiliares), mas o array retornado é sempre novo,
+# porque quem o recebe (ex: o debug) pode guardá-lo
+class Stage:
+    name = None
+
+    def __call__(self, src: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    # parâmetros da etapa, tal como são guardados na configuração
+    def params(self) -> dict:
+        return {}
+
+    def to_dict(self) -> dict:
+        return dict(type=self.name, **self.params())
+
+
+class Grayscale(Stage):
+    name = 'grayscale'
+
+    # uma imagem que já está em grayscale é copiada, para manter o contrato de retornar um array novo
+    def __call__(self, src: np.ndarray) -> np.ndarray:
+        return src.copy() if src.ndim == 2 else _gray(src)
+
+
+# Equalização adaptativa do histograma. O objeto CLAHE é criado uma vez por thread, já que não é
+# seguro partilhá-lo entre threads
+class Clahe(Stage):
+    name = 'clahe'
+
+    def __init__(self, clip_limit: float = CLAHE_CLIP_LIMIT, tile_grid: Tuple[int, int] = CLAHE_TILE_GRID):
+        if clip_limit <= 0 or len(tile_grid) != 2 or min(tile_grid) <= 0:
+            raise ValueError('Invalid CLAHE parameters: clip_limit=%r, tile_grid=%r' % (clip_limit, tile_grid))
+        self.clip_limit = float(clip_limit)
+        self.tile_grid = (int(tile_grid[0]), int(tile_grid[1]))
+        self._local = threading.local()
+
+    def __call__(self, src: np.ndarray) -> np.ndarray:
+        clahe = getattr(self._local, 'clahe', None)
+        if clahe is None:
+            clahe = self._local.clahe = cv2.createCLAHE(clipLimit=self.clip_limit, tileGridSize=self.tile_grid)
+        return clahe.apply(_gray(src))
+
+    def params(self) -> dict:
+        return {'clip_limit': self.clip_limit, 'tile_grid': list(self.tile_grid)}
+
+
+# máscara do espetro de uma FFT real (rfft2) de uma imagem com `shape` que remove as frequências
+# com |fy| < radius e |fx| < radius; partilhada por todas as imagens com o mesmo tamanho
+@functools.lru_cache(maxsize=16)
+def high_pass_mask(shape: Tuple[int, int], radius: int) -> np.ndarray:
+    rows, cols = shape
+    mask = np.ones((rows, cols // 2 + 1), dtype=np.float32)
+    mask[:radius, :radius] = 0
+    mask[max(rows - radius, radius):, :radius] = 0
+    mask.setflags(write=False)
+    return mask
+
+
+# Filtro passa-alto no domínio da frequência, com uma FFT real (metade do espetro de uma FFT complexa)
+# e a máscara de cada tamanho de imagem em cache. O espetro é filtrado no próprio buffer
+class HighPass(Stage):
+    name = 'highpass'
+
+    def __init__(self, radius: int = HIGH_PASS_RADIUS):
+        if radius <= 0:
+            raise ValueError('Invalid high-pass radius: %r' % radius)
+        self.radius = int(radius)
+
+    def __call__(self, src: np.ndarray) -> np.ndarray:
+        gray = _gray(src)
+        spectrum = np.fft.rfft2(gray)
+        spectrum *= high_pass_mask(gray.shape, self.radius)
+        filtered = np.fft.irfft2(spectrum, s=gray.shape)
+        return cv2.convertScaleAbs(filtered)
+
+    def params(self) -> dict:
+        return {'radius': self.radius}
+
+
+# magnitude do laplaciano, calculado em int16 (suficiente para imagens de 8 bits) em vez de float64
+class Laplacian(Stage):
+    name = 'laplacian'
+
+    def __call__(self, src: np.ndarray) -> np.ndarray:
+        return cv2.convertScaleAbs(cv2.Laplacian(_gray(src), cv2.CV_16S))
+
+
+STAGE_CLASSES = {cls.name: cls for cls in (Grayscale, Clahe, HighPass, Laplacian)}
+
+
+# Sequência de etapas aplicada às imagens antes da extração de features. É descrita por uma lista
+# de dicts (ex: [{"type": "grayscale"}, {"type": "clahe", "clip_limit": 2.0}]) guardada na base de
+# dados, para que as entries e as imagens de query sejam sempre preprocessadas da mesma forma
+class Preprocessing:
+    def __init__(self, stages: List[Stage]):
+        self.stages = list(stages)
+        self.signature = json.dumps(self.to_config(), sort_keys=True)
+
+    @classmethod
+    def from_config(cls, config: List[dict]) -> 'Preprocessing':
+        stages = []
+        for data in config:
+            data = dict(data)
+            name = str(data.pop('type', '')).lower()
+            stage_cls = STAGE_CLASSES.get(name)
+            if stage_cls is None:
+                raise ValueError("Unsupported preprocessing stage '%s'" % name)
+            try:
+                stages.append(stage_cls(**data))
+            except TypeError as error:
+                raise ValueError('Invalid %s stage: %s' % (name, error))
+        return cls(stages)
+
+    def to_config(self) -> List[dict]:
+        return [stage.to_dict() for stage in self.stages]
+
+    def apply(self, image: Image) -> Image:
+        src = image.src
+        for stage in self.stages:
+            src = stage(src)
+        return Image(src)
+
+    def __eq__(self, other):
+        return isinstance(other, Preprocessing) and self.signature == other.signature
+
+    def __repr__(self):
+        return ' -> '.join(stage.name for stage in self.stages) or 'identity'
+
+
+DEFAULT_PREPROCESSING = Preprocessing.from_config(DEFAULT_PREPROCESSING_CONFIG)
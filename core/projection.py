@@ -0,0 +1,74 @@
+import math
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core import instrumentation
+from core.augments import Augment, AugmentType
+
+# número de segmentos usados para aproximar uma elipse
+ELLIPSE_SEGMENTS = 64
+# espessura (em pixeis da imagem da entry) com que os augments são desenhados no editor
+AUGMENT_PEN_WIDTH = 5.0
+
+
+# Augment projetado na imagem de query: uma linha poligonal (aberta ou fechada) e a espessura
+# com que deve ser desenhada para ter o mesmo aspeto que na imagem da entry
+class ProjectedAugment:
+    def __init__(self, augment: Augment, points: np.ndarray, closed: bool, width: float):
+        self.augment = augment
+        self.points = points
+        self.closed = closed
+        self.width = width
+
+
+# contorno de um augment nas coordenadas da imagem da entry, com a mesma geometria com que os
+# items do editor o desenham (ver augment_items.py). Retorna (pontos (N, 2), fechado)
+def outline(augment: Augment) -> Optional[Tuple[np.ndarray, bool]]:
+    if augment.type is AugmentType.BOX:
+        x, y = augment.x + 2, augment.y + 2
+        points = [(x, y), (x + augment.w, y), (x + augment.w, y + augment.h), (x, y + augment.h)]
+        return np.float32(points), True
+    if augment.type is AugmentType.ELLIPSE:
+        t = np.linspace(0, 2 * np.pi, ELLIPSE_SEGMENTS, endpoint=False)
+        rx, ry = augment.w / 2, augment.h / 2
+        cx, cy = augment.x + 3 + rx, augment.y + 3 + ry
+        return np.column_stack((cx + rx * np.cos(t), cy + ry * np.sin(t))).astype(np.float32), True
+    if augment.type is AugmentType.ARROW:
+        length = augment.length
+        local = np.float32([(0, 10), (0, -10), (length - 50, -10), (length - 50, -20), (length, 0),
+                            (length - 50, 20), (length - 50, 10), (0, 10)])
+        angle = math.radians(augment.rotation)
+        rotation = np.float32([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+        return local @ rotation.T + np.float32([augment.x, augment.y]), False
+    return None
+
+
+# fator de escala local da homografia num ponto (raiz do determinante do jacobiano)
+def local_scale(homography: np.ndarray, point: np.ndarray) -> float:
+    x, y = float(point[0]), float(point[1])
+    projected = cv2.perspectiveTransform(np.float32([[[x, y]], [[x + 1, y]], [[x, y + 1]]]), homography)
+    dx, dy = projected[1, 0] - projected[0, 0], projected[2, 0] - projected[0, 0]
+    return math.sqrt(abs(float(dx[0] * dy[1] - dx[1] * dy[0])))
+
+
+# Projeta os augments de uma entry na imagem de query como geometria: só os pontos de controlo
+# (cantos, contorno amostrado da elipse, vértices da seta) passam pela homografia, todos numa
+# única chamada a perspectiveTransform. O custo depende dos augments e não do tamanho da imagem
+def project(augments: List[Augment], homography: np.ndarray,
+            width: float = AUGMENT_PEN_WIDTH) -> List[ProjectedAugment]:
+    outlines = [(augment, outline(augment)) for augment in augments]
+    outlines = [(augment, shape) for augment, shape in outlines if shape is not None]
+    if not outlines:
+        return []
+    with instrumentation.span('project_augments'):
+        points = np.concatenate([shape[0] for __, shape in outlines])
+        projected = cv2.perspectiveTransform(points.reshape(-1, 1, 2), homography).reshape(-1, 2)
+        result, start = [], 0
+        for augment, (shape, closed) in outlines:
+            end = start + len(shape)
+            scale = local_scale(homography, shape.mean(axis=0))
+            result.append(ProjectedAugment(augment, projected[start:end], closed, width * scale))
+            start = end
+    return result
@@ -0,0 +1,65 @@
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.feature import array_to_key_points, key_points_to_array
+from core.image import Image
+
+# lado maior, em pixeis, a que as imagens de query são reduzidas por omissão
+DEFAULT_MAX_EDGE = 1600
+
+
+# Política de resolução das imagens de query: a deteção é feita numa versão reduzida da imagem
+# (com o lado maior limitado a `max_edge`) e/ou só são mantidos os `max_key_points` key points
+# com maior resposta. As entries continuam a ser extraídas na resolução original
+class ResolutionPolicy:
+    def __init__(self, max_edge: Optional[int] = DEFAULT_MAX_EDGE, max_key_points: Optional[int] = None):
+        if max_edge is not None and max_edge <= 0:
+            raise ValueError('max_edge must be positive, got %d' % max_edge)
+        if max_key_points is not None and max_key_points <= 0:
+            raise ValueError('max_key_points must be positive, got %d' % max_key_points)
+        self.max_edge = max_edge
+        self.max_key_points = max_key_points
+
+    def __repr__(self):
+        return 'ResolutionPolicy(max_edge=%r, max_key_points=%r)' % (self.max_edge, self.max_key_points)
+
+    # reduz a imagem (nunca a aumenta); retorna a imagem e o fator (sx, sy) que leva as suas
+    # coordenadas de volta à resolução original
+    def resize(self, image: Image) -> Tuple[Image, Tuple[float, float]]:
+        h, w = image.dimensions[:2]
+        if self.max_edge is None or max(h, w) <= self.max_edge:
+            return image, (1.0, 1.0)
+        scale = self.max_edge / max(h, w)
+        size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        resized = Image(cv2.resize(image.src, size, interpolation=cv2.INTER_AREA))
+        return resized, (w / size[0], h / size[1])
+
+    # mantém apenas os key points com maior resposta
+    def limit(self, key_points: List[cv2.KeyPoint],
+              descriptors: Optional[np.ndarray]) -> Tuple[List[cv2.KeyPoint], Optional[np.ndarray]]:
+        if self.max_key_points is None or descriptors is None or len(key_points) <= self.max_key_points:
+            return key_points, descriptors
+        responses = np.array([kp.response for kp in key_points], dtype=np.float32)
+        keep = np.sort(np.argsort(-responses, kind='stable')[:self.max_key_points])
+        return [key_points[i] for i in keep], descriptors[keep]
+
+    # coloca os key points detetados na imagem reduzida nas coordenadas da imagem original,
+    # para que a homografia e o warp dos augments sejam calculados na resolução original
+    @staticmethod
+    def restore(key_points: List[cv2.KeyPoint], factor: Tuple[float, float]) -> List[cv2.KeyPoint]:
+        if factor == (1.0, 1.0) or not key_points:
+            return key_points
+        sx, sy = factor
+        array = key_points_to_array(key_points)
+        # o centro do pixel i da imagem reduzida corresponde a (i + 0.5) * s - 0.5 na original
+        array['x'] = (array['x'] + 0.5) * sx - 0.5
+        array['y'] = (array['y'] + 0.5) * sy - 0.5
+        array['size'] *= (sx + sy) / 2
+        return array_to_key_points(array)
+
+
+DEFAULT_RESOLUTION = ResolutionPolicy()
+# deteção na resolução original, sem limite de key points
+FULL_RESOLUTION = ResolutionPolicy(max_edge=None)
@@ -0,0 +1,383 @@
+import os
+import pickle
+import shutil
+import struct
+import zlib
+from functools import partial
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.feature import KEY_POINT_DTYPE
+from core.image import LazyImage
+from log import logger
+
+# Formato em disco da base de dados (versão FORMAT_VERSION). Para uma base de dados `dev.db`:
+#   dev.db                  índice: MAGIC + versão + pickle com os metadados (nome, grupo, augments e a
+#                           localização dos dados de cada entry). É o único ficheiro lido no arranque
+#   dev.db.<g>.descriptors  descritores de todas as entries, em linhas little-endian (np.memmap)
+#   dev.db.<g>.keypoints    key points de todas as entries, com o layout KEY_POINT_DTYPE (np.memmap)
+#   dev.db.<g>.words        palavra visual de cada descritor (int32, -1 se não houver vocabulário),
+#                           alinhada linha a linha com os descritores (np.memmap)
+#   dev.db.<g>.images       imagens de cada entry comprimidas em PNG, uma a seguir à outra; só são
+#                           descodificadas quando os pixeis forem precisos (ver LazyImage)
+#   dev.db.<g>.log          log append-only com as alterações feitas depois de o índice ser escrito
+# <g> é a geração atual. A compactação escreve uma geração nova e só a torna visível quando o índice
+# é substituído de forma atómica; as alterações entre compactações só acrescentam dados ao fim dos ficheiros
+MAGIC = b'RVAUDB\0'
+FORMAT_VERSION = 2
+VERSION = struct.Struct('<H')
+
+# cada registo do log tem um cabeçalho (operação, tamanho, crc32) seguido do payload em pickle
+RECORD_HEADER = struct.Struct('<BII')
+OP_ADD = 1
+OP_REMOVE = 2
+# o log só é compactado quando for maior que o índice (e que este mínimo), ou quando mais de metade
+# dos descritores guardados já não pertence a nenhuma entry, para que o custo da compactação fique
+# amortizado pelas escritas que a provocaram
+COMPACT_MIN_BYTES = 1024 * 1024
+COMPACT_MIN_ROWS = 100000
+PNG_COMPRESSION = 3
+WORDS_DTYPE = np.dtype('<i4')
+DATA_FILES = ('descriptors', 'keypoints', 'words', 'images')
+
+
+# fsync da diretoria para que um rename atómico sobreviva a uma falha de energia
+def fsync_dir(path: str):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# escreve um ficheiro de forma atómica: ficheiro temporário, fsync e rename por cima do original
+def atomic_write(path: str, data: bytes):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+    fsync_dir(path)
+
+
+def write_record(file: BinaryIO, op: int, payload: object):
+    data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+    file.write(RECORD_HEADER.pack(op, len(data), zlib.crc32(data)))
+    file.write(data)
+
+
+# percorre os registos de um log por ordem. Um registo incompleto ou corrompido no fim do log
+# (ex: o processo morreu a meio de uma escrita) é descartado
+def read_records(path: str) -> Iterator[Tuple[int, object]]:
+    try:
+        file = open(path, 'r+b')
+    except FileNotFoundError:
+        return
+    with file:
+        valid = 0
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            op, length, crc = RECORD_HEADER.unpack(header)
+            data = file.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                break
+            valid = file.tell()
+            yield op, pickle.loads(data)
+        if valid != os.fstat(file.fileno()).st_size:
+            logger.warning('Discarding torn records at the end of %s', path)
+            file.truncate(valid)
+            os.fsync(file.fileno())
+
+
+def read_blob(path: str, offset: int, length: int) -> bytes:
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        return file.read(length)
+
+
+# np.memmap não aceita ficheiros vazios
+def memmap(path: str, dtype: np.dtype, shape: Tuple[int, ...]) -> np.ndarray:
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.empty((0,) + shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r').reshape((-1,) + shape)
+
+
+# Motor de armazenamento em colunas da base de dados (ver o formato acima).
+# Cada registo de uma entry guarda onde estão os seus dados:
+#   {'name', 'group', 'augments', 'rows': (primeira linha, número de linhas),
+#    'image': (offset, tamanho em bytes, altura, largura, canais)}
+class Store:
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.generation = 0
+        self.meta: dict = {}
+        self.descriptor_dtype: Optional[np.dtype] = None
+        self.descriptor_dim: Optional[int] = None
+        self.rows = 0
+        self.dead_rows = 0
+        self._descriptors: Optional[np.ndarray] = None
+        self._key_points: Optional[np.ndarray] = None
+        self._words: Optional[np.ndarray] = None
+
+    def path(self, kind: str, generation: Optional[int] = None) -> str:
+        return '%s.%d.%s' % (self.filename, self.generation if generation is None else generation, kind)
+
+    # True se o ficheiro ainda estiver no formato antigo (a base de dados inteira num pickle)
+    def is_legacy(self) -> bool:
+        try:
+            with open(self.filename, 'rb') as file:
+                magic = file.read(len(MAGIC))
+        except FileNotFoundError:
+            return False
+        return magic != MAGIC
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filename)
+
+    # lê a base de dados antiga em pickle, juntamente com as alterações do seu log (<ficheiro>.log)
+    def read_legacy(self):
+        with open(self.filename, 'rb') as file:
+            db = pickle.load(file)
+        entries = {e.name: e for e in db.entries}
+        for op, payload in read_records(self.filename + '.log'):
+            if op == OP_ADD:
+                entries[payload.name] = payload
+            elif op == OP_REMOVE:
+                entries.pop(payload, None)
+        return entries
+
+    # a migração guarda uma cópia do pickle antigo antes de o substituir pelo índice novo,
+    # e só arquiva o log antigo depois de o índice novo estar escrito
+    def backup_legacy(self):
+        shutil.copy2(self.filename, self.filename + '.pickle.bak')
+
+    def finish_migration(self):
+        if os.path.exists(self.filename + '.log'):
+            os.replace(self.filename + '.log', self.filename + '.pickle.bak.log')
+
+    # lê o índice e aplica o log; os descritores e key points ficam mapeados em memória
+    # e só são lidos do disco quando forem acedidos
+    def load(self) -> Dict[str, dict]:
+        with open(self.filename, 'rb') as file:
+            file.read(len(MAGIC))
+            version, = VERSION.unpack(file.read(VERSION.size))
+            if version > FORMAT_VERSION:
+                raise ValueError('Database %s uses format version %d, but only up to %d is supported'
+                                 % (self.filename, version, FORMAT_VERSION))
+            index = pickle.load(file)
+        self.generation = index['generation']
+        self.meta = index['meta']
+        if index['descriptors'] is not None:
+            self.descriptor_dtype, self.descriptor_dim = np.dtype(index['descriptors'][0]), index['descriptors'][1]
+        records = {r['name']: r for r in index['entries']}
+        # fim dos dados escritos por entries guardadas no índice ou no log (linhas, bytes das imagens)
+        rows, image_bytes = 0, 0
+        for record in index['entries']:
+            rows, image_bytes = self._extent(record, rows, image_bytes)
+        for op, payload in read_records(self.path('log')):
+            if op == OP_ADD:
+                dtype, dim = payload.pop('descriptors')
+                self.descriptor_dtype, self.descriptor_dim = np.dtype(dtype), dim
+                self.discard(records.get(payload['name']))
+                records[payload['name']] = payload
+                rows, image_bytes = self._extent(payload, rows, image_bytes)
+            elif op == OP_REMOVE:
+                self.discard(records.pop(payload, None))
+        self._truncate(rows, image_bytes)
+        self._map()
+        return records
+
+    @staticmethod
+    def _extent(record: dict, rows: int, image_bytes: int) -> Tuple[int, int]:
+        start, count = record['rows']
+        offset, length = record['image'][:2]
+        return max(rows, start + count), max(image_bytes, offset + length)
+
+    # Descarta os dados escritos depois do último registo do log (ex: o processo morreu entre a escrita
+    # dos dados de uma entry e a do seu registo). Sem isto, as colunas ficariam desalinhadas, porque a
+    # entry seguinte começaria na linha a seguir ao fim do ficheiro dos descritores
+    def _truncate(self, rows: int, image_bytes: int):
+        row_bytes = (self.descriptor_dtype.itemsize * self.descriptor_dim) if self.descriptor_dtype is not None else 0
+        sizes = {'descriptors': rows * row_bytes,
+                 'keypoints': rows * KEY_POINT_DTYPE.itemsize,
+                 'words': rows * WORDS_DTYPE.itemsize,
+                 'images': image_bytes}
+        for kind, size in sizes.items():
+            path = self.path(kind)
+            # a coluna das palavras pode estar atrasada (versão 1 do formato); só o que sobra é cortado
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                logger.warning('Discarding %d uncommitted bytes at the end of %s', os.path.getsize(path) - size, path)
+                with open(path, 'r+b') as file:
+                    file.truncate(size)
+                    os.fsync(file.fileno())
+
+    # conta as linhas de uma entry que deixou de existir, para saber quando vale a pena compactar
+    def discard(self, record: Optional[dict]):
+        if record is not None:
+            self.dead_rows += record['rows'][1]
+
+    def _map(self):
+        self._descriptors = memmap(self.path('descriptors'), self.descriptor_dtype or np.float32,
+                                   (self.descriptor_dim or 0,))
+        self._key_points = memmap(self.path('keypoints'), KEY_POINT_DTYPE, ())
+        self._words = memmap(self.path('words'), WORDS_DTYPE, ())
+        self.rows = len(self._key_points)
+
+    def key_points(self, record: dict) -> np.ndarray:
+        start, count = record['rows']
+        return self._key_points[start:start + count]
+
+    def descriptors(self, record: dict) -> np.ndarray:
+        start, count = record['rows']
+        return self._descriptors[start:start + count]
+
+    # palavras visuais da entry, ou None se foi guardada sem vocabulário (ou antes da versão 2 do formato)
+    def words(self, record: dict) -> Optional[np.ndarray]:
+        start, count = record['rows']
+        words = self._words[start:start + count]
+        if len(words) < count or (count and words[0] < 0):
+            return None
+        return words
+
+    # função que lê a imagem comprimida de uma entry; o caminho é fixado agora porque a geração
+    # pode mudar depois de uma compactação
+    def image_loader(self, record: dict) -> Callable[[], bytes]:
+        offset, length = record['image'][:2]
+        return partial(read_blob, self.path('images'), offset, length)
+
+    @staticmethod
+    def image_shape(record: dict) -> Tuple[int, ...]:
+        h, w, channels = record['image'][2:]
+        return (h, w, channels) if channels > 1 else (h, w)
+
+    def _check_descriptors(self, descriptors: np.ndarray):
+        dtype, dim = descriptors.dtype.newbyteorder('<'), descriptors.shape[1] if descriptors.ndim == 2 else 0
+        if self.descriptor_dtype is None:
+            self.descriptor_dtype, self.descriptor_dim = dtype, dim
+        elif (dtype, dim) != (self.descriptor_dtype, self.descriptor_dim):
+            raise ValueError('Descriptors of type %s[%d] do not match the database (%s[%d])'
+                             % (dtype, dim, self.descriptor_dtype, self.descriptor_dim))
+
+    # acrescenta os dados de uma entry ao fim dos ficheiros abertos e retorna o seu registo
+    def _write_entry(self, entry, files: Dict[str, BinaryIO]) -> dict:
+        self._check_descriptors(entry.descriptors)
+        descriptors = np.ascontiguousarray(entry.descriptors, dtype=self.descriptor_dtype)
+        key_points = np.ascontiguousarray(entry.key_point_array, dtype=KEY_POINT_DTYPE)
+        row_bytes = self.descriptor_dtype.itemsize * self.descriptor_dim
+        start = files['descriptors'].seek(0, os.SEEK_END) // row_bytes if row_bytes else 0
+        files['descriptors'].write(descriptors.tobytes())
+        files['keypoints'].write(key_points.tobytes())
+        # as bases de dados da versão 1 não tinham palavras, por isso a coluna pode estar atrasada
+        missing = start - files['words'].seek(0, os.SEEK_END) // WORDS_DTYPE.itemsize
+        if missing > 0:
+            files['words'].write(np.full(missing, -1, dtype=WORDS_DTYPE).tobytes())
+        words = entry.words if entry.words is not None else np.full(len(descriptors), -1)
+        files['words'].write(np.ascontiguousarray(words, dtype=WORDS_DTYPE).tobytes())
+        if isinstance(entry.img, LazyImage):
+            # a imagem já está comprimida noutra geração; é copiada sem ser descodificada
+            png = entry.img.encoded
+        else:
+            ok, png = cv2.imencode('.png', entry.img.src, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+            assert ok, 'Could not encode the image of %s' % entry.name
+            png = png.tobytes()
+        offset = files['images'].seek(0, os.SEEK_END)
+        files['images'].write(png)
+        shape = entry.img.dimensions
+        return {'name': entry.name,
+                'group': entry.group,
+                'augments': entry.augments,
+                'rows': (start, len(descriptors)),
+                'image': (offset, len(png), shape[0], shape[1], shape[2] if len(shape) == 3 else 1)}
+
+    def _open(self, mode: str, generation: Optional[int] = None) -> Dict[str, BinaryIO]:
+        return {kind: open(self.path(kind, generation), mode) for kind in DATA_FILES}
+
+    @staticmethod
+    def _sync(files: Dict[str, BinaryIO]):
+        for file in files.values():
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+
+    # uma alteração escreve apenas os dados da entry e um registo no log; o custo não depende
+    # do tamanho da base de dados
+    def append_entry(self, entry) -> dict:
+        return self.append_entries([entry])[0]
+
+    # várias entries de uma só vez: os ficheiros de dados e o log só são abertos e sincronizados uma vez
+    def append_entries(self, entries: Iterable) -> List[dict]:
+        files = self._open('ab')
+        sizes = {kind: file.seek(0, os.SEEK_END) for kind, file in files.items()}
+        try:
+            records = [self._write_entry(entry, files) for entry in entries]
+        except BaseException:
+            # nenhuma entry chega ao log, por isso os dados que já foram escritos são descartados
+            for kind, file in files.items():
+                file.truncate(sizes[kind])
+            raise
+        finally:
+            self._sync(files)
+        # o tipo dos descritores vai em cada registo porque o índice pode ter sido escrito antes da primeira entry
+        spec = (self.descriptor_dtype.str, self.descriptor_dim) if self.descriptor_dtype is not None else None
+        self._append(*((OP_ADD, dict(record, descriptors=spec)) for record in records))
+        self.rows += sum(record['rows'][1] for record in records)
+        return records
+
+    def append_remove(self, record: dict):
+        self._append((OP_REMOVE, record['name']))
+        self.discard(record)
+
+    def _append(self, *records: Tuple[int, object]):
+        with open(self.path('log'), 'ab') as file:
+            for op, payload in records:
+                write_record(file, op, payload)
+            file.flush()
+            os.fsync(file.fileno())
+
+    @property
+    def needs_compaction(self) -> bool:
+        try:
+            log_size = os.path.getsize(self.path('log'))
+        except FileNotFoundError:
+            log_size = 0
+        index_size = os.path.getsize(self.filename) if self.exists() else 0
+        return (log_size >= max(COMPACT_MIN_BYTES, index_size) or
+                self.dead_rows >= max(COMPACT_MIN_ROWS, self.rows - self.dead_rows))
+
+    # escreve todas as entries numa geração nova, torna-a visível substituindo o índice de forma atómica
+    # e só depois apaga a geração anterior
+    def compact(self, entries: Iterable) -> Dict[str, dict]:
+        previous, generation = self.generation, self.generation + 1
+        files = self._open('wb', generation)
+        try:
+            records = [self._write_entry(entry, files) for entry in entries]
+        finally:
+            self._sync(files)
+        open(self.path('log', generation), 'wb').close()
+        self.write_index(records, generation)
+        self.generation, self.dead_rows = generation, 0
+        for kind in DATA_FILES + ('log',):
+            path = self.path(kind, previous)
+            if os.path.exists(path):
+                os.remove(path)
+        self._map()
+        return {r['name']: r for r in records}
+
+    def write_index(self, records: Iterable[dict], generation: Optional[int] = None):
+        logger.info('Saving database: %s', self.filename)
+        descriptors = None
+        if self.descriptor_dtype is not None:
+            descriptors = (self.descriptor_dtype.str, self.descriptor_dim)
+        index = {'generation': self.generation if generation is None else generation,
+                 'meta': self.meta,
+                 'descriptors': descriptors,
+                 'entries': list(records)}
+        atomic_write(self.filename, MAGIC + VERSION.pack(FORMAT_VERSION) +
+                     pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
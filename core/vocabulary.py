@@ -0,0 +1,184 @@
+import math
+import pickle
+import uuid
+from collections import defaultdict
+from typing import Container, Dict, Iterable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.cancellation import CancellationToken, ProgressCallback, checkpoint
+from core.storage import atomic_write
+from log import logger
+
+BRANCHING = 10
+DEPTH = 4
+# número máximo de descritores usados para treinar o vocabulário
+TRAINING_SAMPLE = 200000
+KMEANS_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
+# número de entries pré-selecionadas pelo inverted file antes da verificação com o matcher
+SHORTLIST = 20
+
+
+# Vocabulário visual em árvore (k-means hierárquico): cada descritor desce a árvore escolhendo em cada nível
+# o centro mais próximo, e a folha onde chega é a sua "palavra visual".
+# Os descritores binários são tratados como vetores de bytes
+class Vocabulary:
+    def __init__(self, centers: np.ndarray, children: np.ndarray, words: np.ndarray, id: Optional[str] = None):
+        # centers[n] é o centro do nó n; children[n] são os filhos do nó n (-1 se não existirem);
+        # words[n] é a palavra do nó n se for uma folha (-1 nos nós internos). O nó 0 é a raiz
+        self.centers = centers
+        self.children = children
+        self.words = words
+        self.id = id if id is not None else uuid.uuid4().hex
+        self._center_norms = (centers ** 2).sum(axis=1)
+
+    def __len__(self):
+        return int(self.words.max()) + 1 if len(self.words) else 0
+
+    # o progresso é a fração dos descritores que já chegou a uma folha; o cancelamento é verificado
+    # antes de cada k-means
+    @classmethod
+    def train(cls, descriptors: np.ndarray, branching: int = BRANCHING, depth: int = DEPTH,
+              sample: int = TRAINING_SAMPLE, token: Optional[CancellationToken] = None,
+              progress: Optional[ProgressCallback] = None) -> 'Vocabulary':
+        data = np.asarray(descriptors, dtype=np.float32)
+        if len(data) > sample:
+            data = data[np.random.RandomState(0).choice(len(data), sample, replace=False)]
+        centers, children = [data.mean(axis=0)], [[-1] * branching]
+        done = [0]
+
+        def split(node: int, rows: np.ndarray, level: int):
+            if level == depth or len(rows) < 2 * branching:
+                done[0] += len(rows)
+                return
+            checkpoint(token, progress, 'vocabulary', done[0] / len(data))
+            __, labels, k_centers = cv2.kmeans(rows, branching, None, KMEANS_CRITERIA, 1, cv2.KMEANS_PP_CENTERS)
+            labels = labels.ravel()
+            for i in range(branching):
+                child = len(centers)
+                centers.append(k_centers[i])
+                children.append([-1] * branching)
+                children[node][i] = child
+                split(child, rows[labels == i], level + 1)
+
+        split(0, data, 0)
+        children = np.array(children, dtype=np.int32)
+        leaves = (children < 0).all(axis=1)
+        words = np.full(len(children), -1, dtype=np.int32)
+        words[leaves] = np.arange(leaves.sum(), dtype=np.int32)
+        logger.info('Trained a vocabulary with %d words from %d descriptors', leaves.sum(), len(data))
+        return cls(np.array(centers, dtype=np.float32), children, words)
+
+    # palavra visual de cada descritor
+    def quantize(self, descriptors: np.ndarray) -> np.ndarray:
+        data = np.asarray(descriptors, dtype=np.float32)
+        norms = (data ** 2).sum(axis=1)
+        nodes = np.zeros(len(data), dtype=np.int32)
+        while True:
+            inner = np.flatnonzero(self.words[nodes] < 0)
+            if len(inner) == 0:
+                return self.words[nodes]
+            for node in np.unique(nodes[inner]):
+                rows = inner[nodes[inner] == node]
+                children = self.children[node]
+                children = children[children >= 0]
+                # |x - c|² = |x|² - 2 x.c + |c|²
+                distances = (norms[rows, None] - 2 * data[rows] @ self.centers[children].T +
+                             self._center_norms[children][None, :])
+                nodes[rows] = children[distances.argmin(axis=1)]
+
+    def save(self, path: str):
+        atomic_write(path, pickle.dumps({'id': self.id, 'centers': self.centers, 'children': self.children,
+                                         'words': self.words}, pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def load(cls, path: str) -> Optional['Vocabulary']:
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with file:
+            data = pickle.load(file)
+        return cls(data['centers'], data['children'], data['words'], data['id'])
+
+
+# histograma (palavras distintas, frequência relativa) das palavras visuais de uma imagem
+def bag_of_words(words: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    unique, counts = np.unique(words, return_counts=True)
+    return unique.astype(np.int32), (counts / max(1, len(words))).astype(np.float32)
+
+
+# Inverted file: para cada palavra visual, as entries onde aparece e com que frequência (tf).
+# Uma query só percorre as listas das palavras que contém, com pesos TF-IDF, por isso o custo depende
+# do número de entries que partilham palavras com a query e não do tamanho da base de dados
+class InvertedFile:
+    def __init__(self, vocabulary: Vocabulary):
+        self.vocabulary = vocabulary
+        self.postings: Dict[int, Dict[str, float]] = defaultdict(dict)
+        self.documents: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._norms: Optional[Dict[str, float]] = None
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, name: str, words: np.ndarray):
+        self.remove(name)
+        unique, tf = bag_of_words(words)
+        self.documents[name] = (unique, tf)
+        for word, frequency in zip(unique.tolist(), tf.tolist()):
+            self.postings[word][name] = frequency
+        self._norms = None
+
+    def remove(self, name: str):
+        document = self.documents.pop(name, None)
+        if document is None:
+            return
+        for word in document[0].tolist():
+            posting = self.postings[word]
+            posting.pop(name, None)
+            if not posting:
+                del self.postings[word]
+        self._norms = None
+
+    def idf(self, word: int) -> float:
+        return math.log(len(self.documents) / len(self.postings[word]))
+
+    # as normas dos documentos dependem do idf, que muda sempre que uma entry é adicionada ou removida,
+    # por isso só são recalculadas na primeira query depois de uma alteração
+    @property
+    def norms(self) -> Dict[str, float]:
+        if self._norms is None:
+            idf = {word: self.idf(word) for word in self.postings}
+            self._norms = {}
+            for name, (unique, tf) in self.documents.items():
+                weights = tf * np.array([idf[w] for w in unique.tolist()], dtype=np.float32)
+                self._norms[name] = float(np.sqrt((weights ** 2).sum())) or 1.0
+        return self._norms
+
+    # retorna as `top` entries mais parecidas com os descritores da query (similaridade de cosseno TF-IDF),
+    # opcionalmente só de entre as entries em `names`
+    def query(self, descriptors: np.ndarray, top: int,
+              names: Optional[Container[str]] = None) -> List[Tuple[str, float]]:
+        if not self.documents or descriptors is None or len(descriptors) == 0:
+            return []
+        unique, tf = bag_of_words(self.vocabulary.quantize(descriptors))
+        scores: Dict[str, float] = defaultdict(float)
+        for word, frequency in zip(unique.tolist(), tf.tolist()):
+            posting = self.postings.get(word)
+            if not posting:
+                continue
+            weight = frequency * self.idf(word) ** 2
+            for name, document_frequency in posting.items():
+                scores[name] += weight * document_frequency
+        norms = self.norms
+        ranked = sorted(((score / norms[name], name) for name, score in scores.items()
+                         if names is None or name in names), reverse=True)
+        return [(name, score) for score, name in ranked[:top]]
+
+    @classmethod
+    def build(cls, vocabulary: Vocabulary, documents: Iterable[Tuple[str, np.ndarray]]) -> 'InvertedFile':
+        inverted = cls(vocabulary)
+        for name, words in documents:
+            inverted.add(name, words)
+        return inverted
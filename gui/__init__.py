@@ -1,5 +1,5 @@
 from gui.add_entry_window import AddEntryWindow
 from gui.entry_editor_view import EntryEditorView
 from gui.entry_editor_scene import EntryEditorScene, EntryEditorState
-from gui.feature_item import FeatureItem
+from gui.key_point_layer import KeyPointLayer
 from gui.main_window import MainWindow
\ No newline at end of file
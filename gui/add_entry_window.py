@@ -4,10 +4,12 @@ from PyQt5 import (QtWidgets as qt,
                    QtGui as gui,
                    QtCore as qtc)
 from PyQt5.QtCore import Qt
-from core import Image, Matcher, Entry, Database
+from core import Image, Matcher, Entry, Database, Feature
 from core.augments import AugmentType
+import gui.workers as workers
 from gui.entry_editor_scene import EntryEditorScene, EntryEditorState
 from gui.entry_editor_view import EntryEditorView
+from gui.workers import Task
 from log import logger
 
 
@@ -21,6 +23,8 @@ class AddEntryWindow(qt.QMainWindow):
         self.toolbar: qt.QToolBar = None
         self.tool_features: qt.QAction = None
         self.tool_save: qt.QAction = None
+        self.__features_task: Optional[Task] = None
+        self.__save_task: Optional[Task] = None
         self.configure_window()
         self.configure_toolbar()
 
@@ -107,6 +111,12 @@ class AddEntryWindow(qt.QMainWindow):
         self.resize(int(screen_size.width() * 3 / 5), int(screen_size.height() * 3 / 5))
         self.grabGesture(qtc.Qt.PinchGesture)
         self.statusBar().showMessage("Load an image to start")
+        # progresso da extração de features, como na janela principal durante o reconhecimento
+        self.progress_bar = qt.QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.progress_bar)
 
     def configure_toolbar(self):
         self.toolbar = self.addToolBar('Main Toolbar')
@@ -146,17 +156,65 @@ class AddEntryWindow(qt.QMainWindow):
             image = Image.from_file(filename)
             self.editor_scene.load_entry(image)
 
+    # as features são calculadas numa thread de fundo; o editor continua interativo e as features
+    # só aparecem quando estiverem prontas (se ainda forem precisas)
     def select_features(self, state: bool):
         entry = self.editor_scene.entry
         if entry is None:
             return
-        if state and len(self.editor_scene.features) == 0:
-            eq = self.matcher.histogram_equalization(entry['img'])
-            features = self.matcher.features(eq)
-            self.editor_scene.add_features(features)
+        if not state:
+            self.cancel_features()
+        elif len(self.editor_scene.features) == 0:
+            if self.__features_task is None:
+                task = Task(self.__extract_features, entry['img'])
+                task.signals.progress.connect(lambda stage, fraction: self.on_features_progress(task, stage, fraction))
+                task.signals.finished.connect(lambda features: self.on_features_ready(task, entry, features))
+                task.signals.failed.connect(lambda error: self.on_features_done(task, 'Feature extraction failed: '
+                                                                                     + error))
+                task.signals.cancelled.connect(lambda: self.on_features_done(task))
+                self.__features_task = workers.start(task)
+                self.progress_bar.setValue(0)
+                self.progress_bar.show()
+                self.statusBar().showMessage('Computing features: queued')
+            return
         self.editor_scene.state = EntryEditorState.SELECT_FEATURES if state else EntryEditorState.NONE
         self.editor_scene.set_features_visibility(state)
 
+    # executado na thread de fundo
+    def __extract_features(self, task: Task, image: Image):
+        key_points, descriptors = self.matcher.extract(image, token=task.token, progress=task.progress)
+        return Feature.from_key_points(key_points, descriptors)
+
+    def cancel_features(self):
+        if self.__features_task is not None:
+            self.__features_task.cancel()
+            self.__features_task = None
+            self.progress_bar.hide()
+            self.statusBar().showMessage('Feature extraction cancelled')
+
+    def on_features_progress(self, task: Task, stage: str, fraction: float):
+        if task is self.__features_task:
+            self.progress_bar.setValue(int(100 * fraction))
+            self.statusBar().showMessage('Computing features: %s' % stage)
+
+    def on_features_done(self, task: Task, message: Optional[str] = None) -> bool:
+        if task is not self.__features_task:
+            return False
+        self.__features_task = None
+        self.progress_bar.hide()
+        if message is not None:
+            self.statusBar().showMessage(message)
+        return True
+
+    def on_features_ready(self, task: Task, entry: dict, features):
+        if not self.on_features_done(task, '%d features' % len(features)):
+            return
+        if self.editor_scene.entry is not entry or not self.tool_features.isChecked():
+            return
+        self.editor_scene.add_features(features)
+        self.editor_scene.state = EntryEditorState.SELECT_FEATURES
+        self.editor_scene.set_features_visibility(True)
+
     def save_entry(self):
         name = self.entry_name_combo.currentText()
         group = self.entry_group_combo.currentText()
@@ -174,16 +232,37 @@ class AddEntryWindow(qt.QMainWindow):
                 "You only selected %d feature%s" % (len(features), '' if len(features) == 1 else 's'))
             return info_box.exec()
         augments = [a.augment() for a in self.editor_scene.augments]
-        entry = Entry(name, self.editor_scene.entry['img'], features,
-                      augments=augments,
-                      group=group)
-        self._database.add_entry(entry)
+        entry = Entry.from_features(name, self.editor_scene.entry['img'], features,
+                                    augments=augments,
+                                    group=group)
+        # a Database só é alterada na thread de fundo, para não mudar a meio de um reconhecimento
+        task = Task(lambda task, saved: self._database.add_entry(saved), entry)
+        task.signals.finished.connect(lambda __: self.on_entry_saved(task, entry))
+        task.signals.failed.connect(lambda error: self.on_save_failed(task, error))
+        self.__save_task = workers.start(task)
+        self.tool_save.setDisabled(True)
+        self.statusBar().showMessage('Saving...')
+
+    def on_entry_saved(self, task: Task, entry: Entry):
+        if task is not self.__save_task:
+            return
+        self.__save_task = None
+        self.tool_save.setDisabled(self.editor_scene.entry is None)
+        self.statusBar().showMessage("Saved '%s'" % entry.name)
         info_box = qt.QMessageBox(self)
         info_box.setIcon(qt.QMessageBox.Information)
         info_box.setText("Saved successfully as '%s'" % entry.name)
         info_box.exec()
         self.entry_saved.emit(entry)
 
+    def on_save_failed(self, task: Task, error: str):
+        if task is not self.__save_task:
+            return
+        self.__save_task = None
+        self.tool_save.setDisabled(self.editor_scene.entry is None)
+        self.statusBar().showMessage('Save failed')
+        qt.QMessageBox.critical(self, 'Save failed', error)
+
     def toolbar_button(self, text: str, tooltip: Optional[str] = None, shortcut: Optional[str] = None) -> qt.QAction:
         action = qt.QAction(text, self)
         tooltip = tooltip if tooltip is not None else text
@@ -233,9 +312,10 @@ class AddEntryWindow(qt.QMainWindow):
             self.editor_scene.state = EntryEditorState.NONE
 
     def on_entry_change(self):
+        self.cancel_features()
         self.tool_features.setDisabled(self.editor_scene.entry is None)
         self.tool_features.setChecked(False)
-        self.tool_save.setDisabled(self.editor_scene.entry is None)
+        self.tool_save.setDisabled(self.editor_scene.entry is None or self.__save_task is not None)
         if self.editor_scene.entry is None:
             self.statusBar().showMessage("Load an image to start")
 
@@ -251,6 +331,7 @@ class AddEntryWindow(qt.QMainWindow):
                                         "Are you sure you want to close?", qt.QMessageBox.Yes |
                                         qt.QMessageBox.No, qt.QMessageBox.No)
         if reply == qt.QMessageBox.Yes:
+            self.cancel_features()
             event.accept()
         else:
             event.ignore()
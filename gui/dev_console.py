@@ -0,0 +1,180 @@
+from collections import deque
+from typing import Any, Deque, Optional
+
+import cv2
+import numpy as np
+from PyQt5 import (QtWidgets as qt,
+                   QtGui as gui,
+                   QtCore as qtc)
+from PyQt5.QtCore import Qt
+
+import gui.utils as utils
+
+# memória máxima ocupada pelas imagens guardadas na consola
+DEV_CONSOLE_BYTES = 256 * 1024 * 1024
+# maior lado das miniaturas mostradas na lista
+THUMBNAIL_SIZE = 240
+
+
+# Resultado intermédio (descrição e imagem completa); a miniatura só é criada quando é mostrada
+class DevResult:
+    def __init__(self, text: str, image: np.ndarray):
+        self.text = text
+        self.image = image
+        self.thumbnail: Optional[gui.QPixmap] = None
+
+    @property
+    def nbytes(self) -> int:
+        return self.image.nbytes
+
+    def get_thumbnail(self) -> gui.QPixmap:
+        if self.thumbnail is None:
+            h, w = self.image.shape[:2]
+            scale = min(1.0, THUMBNAIL_SIZE / max(h, w, 1))
+            small = self.image
+            if scale < 1.0:
+                small = cv2.resize(self.image, (max(1, round(w * scale)), max(1, round(h * scale))),
+                                   interpolation=cv2.INTER_AREA)
+            small = np.ascontiguousarray(small)
+            # o QPixmap copia os pixeis, por isso o array temporário pode ser libertado
+            self.thumbnail = gui.QPixmap.fromImage(utils.numpy_to_qimage(small))
+        return self.thumbnail
+
+
+# Histórico dos resultados num buffer circular: os mais antigos são descartados quando as imagens
+# ultrapassam `max_bytes` (o mais recente é sempre mantido). A lista mostra o mais recente primeiro
+# e, sendo um QListView, só pede as miniaturas das linhas visíveis
+class DevResultModel(qtc.QAbstractListModel):
+    def __init__(self, max_bytes: int = DEV_CONSOLE_BYTES):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # o resultado mais recente fica no início
+        self._results: Deque[DevResult] = deque()
+
+    def rowCount(self, parent: qtc.QModelIndex = qtc.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._results)
+
+    def data(self, index: qtc.QModelIndex, role: int = Qt.DisplayRole) -> Any:
+        if not index.isValid() or index.row() >= len(self._results):
+            return None
+        result = self._results[index.row()]
+        if role == Qt.DisplayRole:
+            return result.text
+        if role == Qt.DecorationRole:
+            return result.get_thumbnail()
+        if role == Qt.ToolTipRole:
+            h, w = result.image.shape[:2]
+            return '%s (%dx%d)' % (result.text, w, h)
+        return None
+
+    def result(self, row: int) -> DevResult:
+        return self._results[row]
+
+    def add(self, result: DevResult):
+        self.beginInsertRows(qtc.QModelIndex(), 0, 0)
+        self._results.appendleft(result)
+        self.nbytes += result.nbytes
+        self.endInsertRows()
+        self.trim()
+
+    def set_max_bytes(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.trim()
+
+    def trim(self):
+        excess = 0
+        nbytes = self.nbytes
+        while len(self._results) - excess > 1 and nbytes > self.max_bytes:
+            nbytes -= self._results[len(self._results) - 1 - excess].nbytes
+            excess += 1
+        if excess:
+            last = len(self._results) - 1
+            self.beginRemoveRows(qtc.QModelIndex(), last - excess + 1, last)
+            for __ in range(excess):
+                self._results.pop()
+            self.nbytes = nbytes
+            self.endRemoveRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self._results.clear()
+        self.nbytes = 0
+        self.endResetModel()
+
+
+# janela com a imagem de um resultado na resolução original, criada só quando é pedida
+class DevResultViewer(qt.QScrollArea):
+    def __init__(self, result: DevResult):
+        super().__init__()
+        self.setWindowTitle(result.text)
+        label = qt.QLabel()
+        label.setPixmap(gui.QPixmap.fromImage(utils.numpy_to_qimage(np.ascontiguousarray(result.image))))
+        self.setWidget(label)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.resize(min(label.sizeHint().width() + 20, 1280), min(label.sizeHint().height() + 20, 900))
+
+
+class DevConsole(qt.QWidget):
+    closed = qtc.pyqtSignal()
+
+    def __init__(self, max_bytes: int = DEV_CONSOLE_BYTES):
+        super().__init__()
+        self.setWindowTitle('Results View')
+        self.model = DevResultModel(max_bytes)
+        self.viewers = []
+        self.main_layout = qt.QVBoxLayout()
+
+        controls = qt.QHBoxLayout()
+        controls.addWidget(qt.QLabel('Budget (MiB)'))
+        self.budget = qt.QSpinBox()
+        self.budget.setRange(1, 64 * 1024)
+        self.budget.setValue(max(1, max_bytes // (1024 * 1024)))
+        self.budget.valueChanged.connect(lambda mib: self.set_max_bytes(mib * 1024 * 1024))
+        controls.addWidget(self.budget)
+        self.usage = qt.QLabel()
+        controls.addWidget(self.usage)
+        controls.addStretch()
+        clear_btn = qt.QPushButton('Clear')
+        clear_btn.released.connect(self.clear)
+        controls.addWidget(clear_btn)
+        self.main_layout.addLayout(controls)
+
+        self.list_view = qt.QListView()
+        self.list_view.setModel(self.model)
+        self.list_view.setViewMode(qt.QListView.IconMode)
+        self.list_view.setIconSize(qtc.QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.list_view.setResizeMode(qt.QListView.Adjust)
+        self.list_view.setMovement(qt.QListView.Static)
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setWordWrap(True)
+        self.list_view.setLayoutMode(qt.QListView.Batched)
+        self.list_view.doubleClicked.connect(self.open_result)
+        self.main_layout.addWidget(self.list_view)
+        self.setLayout(self.main_layout)
+        self.update_usage()
+
+    def add_result(self, text: str, image: np.array):
+        self.model.add(DevResult(text, image))
+        self.update_usage()
+
+    def set_max_bytes(self, max_bytes: int):
+        self.model.set_max_bytes(max_bytes)
+        self.update_usage()
+
+    def clear(self):
+        self.model.clear()
+        self.update_usage()
+
+    def update_usage(self):
+        self.usage.setText('%d results, %.1f MiB' % (self.model.rowCount(), self.model.nbytes / (1024 * 1024)))
+
+    def closeEvent(self, event):
+        super().closeEvent(event)
+        self.closed.emit()
+
+    def open_result(self, index: qtc.QModelIndex):
+        viewer = DevResultViewer(self.model.result(index.row()))
+        viewer.destroyed.connect(lambda: self.viewers.remove(viewer))
+        self.viewers.append(viewer)
+        viewer.show()
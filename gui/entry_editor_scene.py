@@ -7,10 +7,12 @@ from PyQt5 import (QtWidgets as qt,
 from PyQt5.QtCore import Qt
 
 import math
+import numpy as np
 from core import Image, Feature
 from core.augments import AugmentType
+from core.feature import KEY_POINT_DTYPE, key_point_positions
 from gui.augment_items import AugmentItem, BoxAugmentItem, ArrowAugmentItem, EllipseAugmentItem
-from gui.feature_item import FeatureItem
+from gui.key_point_layer import KeyPointLayer
 
 
 @unique
@@ -28,9 +30,12 @@ class EntryEditorScene(qt.QGraphicsScene):
         super().__init__()
         self.state: EntryEditorState = EntryEditorState.NONE
         self.entry: dict = None
-        self.features: List[FeatureItem] = []
-        self._selected_features: Set[FeatureItem] = set()
-        self._clicked: List[FeatureItem] = []
+        self.features: List[Feature] = []
+        # todas as features são desenhadas por um único item; as seleções são resolvidas com o seu
+        # índice espacial e o estado de seleção é uma máscara com uma posição por feature
+        self._feature_layer: KeyPointLayer = None
+        self._selection: np.ndarray = np.zeros(0, dtype=bool)
+        self._clicked: np.ndarray = np.empty(0, dtype=np.int64)
         self._selection_rect: dict = None
         self._selection_rect_ui: qt.QGraphicsRectItem = None
 
@@ -48,6 +53,8 @@ class EntryEditorScene(qt.QGraphicsScene):
     def load_entry(self, img: Image):
         self.state = EntryEditorState.NONE
         self.features.clear()
+        self._feature_layer = None
+        self._selection = np.zeros(0, dtype=bool)
         self._selected = None
         self._dragging = None
         self.clear()
@@ -62,25 +69,22 @@ class EntryEditorScene(qt.QGraphicsScene):
         self.entry_changed.emit()
 
     def add_features(self, features: List[Feature]):
-        for f in self.features:
-            self.removeItem(f)
-        self.features.clear()
-        self._selected_features.clear()
-        for f in features:
-            feature_item = FeatureItem(f)
-            feature_item.setPos(*feature_item.position)
-            self.addItem(feature_item)
-            self.features.append(feature_item)
+        if self._feature_layer is not None:
+            self.removeItem(self._feature_layer)
+        self.features = list(features)
+        records = np.array([f.record for f in self.features], dtype=KEY_POINT_DTYPE)
+        self._feature_layer = KeyPointLayer(key_point_positions(records))
+        self._selection = self._feature_layer.selection
+        self.addItem(self._feature_layer)
         self.update()
 
     def set_features_visibility(self, visibility: bool):
-        for f in self.features:
-            f.setVisible(visibility)
-            f.update()
+        if self._feature_layer is not None:
+            self._feature_layer.setVisible(visibility)
 
     @property
     def selected_features(self) -> List[Feature]:
-        return [f.feature for f in self._selected_features]
+        return [self.features[i] for i in np.flatnonzero(self._selection)]
 
     def delete_augment(self):
         if self._selected:
@@ -106,7 +110,7 @@ class EntryEditorScene(qt.QGraphicsScene):
             return
         pos = event.scenePos()
         if self.state is EntryEditorState.SELECT_FEATURES:
-            self._clicked = list(filter(lambda i: type(i) is FeatureItem, self.items(pos)))
+            self._clicked = self.features_at(pos.x(), pos.y())
             self._selection_rect = {'from': (pos.x(), pos.y()), 'to': (pos.x(), pos.y())}
         elif self.state is EntryEditorState.INSERT_AUGMENT_ITEM:
             self._item_start_point = (pos.x(), pos.y())
@@ -126,23 +130,16 @@ class EntryEditorScene(qt.QGraphicsScene):
         if (self.state is EntryEditorState.SELECT_FEATURES and
                 self._selection_rect is not None):
             a, b = self._selection_rect['from'], self._selection_rect['to']
-            top_left = qtc.QPointF(min(a[0], b[0]), min(a[1], b[1]))
-            bottom_right = qtc.QPointF(max(a[0], b[0]), max(a[1], b[1]))
-            rect = qtc.QRectF(top_left, bottom_right)
-            in_selection = self.items(rect)
-            in_selection.extend(self._clicked)
-            self._clicked.clear()
+            in_selection = self._clicked
+            if self._feature_layer is not None:
+                rect = self._feature_layer.index.query_rect(a[0], a[1], b[0], b[1])
+                in_selection = np.concatenate((rect, self._clicked))
+            self._clicked = np.empty(0, dtype=np.int64)
             ctrl = event.modifiers() & Qt.ControlModifier
             shift = event.modifiers() & Qt.ShiftModifier
-            if not ctrl:
-                self.clear_selected_features()
-            for item in in_selection:
-                if type(item) is FeatureItem:
-                    item.selected = not shift
-                    if not shift:
-                        self._selected_features.add(item)
-                    else:
-                        self._selected_features.discard(item)
+            selection = self._selection.copy() if ctrl else np.zeros_like(self._selection)
+            selection[in_selection] = not shift
+            self.set_selection(selection)
             self._selection_rect = None
             self.removeItem(self._selection_rect_ui)
             self._selection_rect_ui = None
@@ -224,7 +221,16 @@ class EntryEditorScene(qt.QGraphicsScene):
             else:
                 self._selection_rect_ui.setRect(rect)
 
+    # índices das features cujo círculo contém o ponto (x, y)
+    def features_at(self, x: float, y: float) -> np.ndarray:
+        if self._feature_layer is None:
+            return np.empty(0, dtype=np.int64)
+        return self._feature_layer.at(x, y)
+
+    def set_selection(self, selection: np.ndarray):
+        self._selection = selection
+        if self._feature_layer is not None:
+            self._feature_layer.set_selection(selection)
+
     def clear_selected_features(self):
-        for f in self._selected_features:
-            f.selected = False
-        self._selected_features.clear()
+        self.set_selection(np.zeros_like(self._selection))
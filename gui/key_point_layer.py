@@ -0,0 +1,80 @@
+import typing
+
+import numpy as np
+from PyQt5 import (QtWidgets as qt,
+                   QtGui as gui,
+                   QtCore as qtc)
+
+from gui.spatial_index import GridIndex
+
+# abaixo deste diâmetro no ecrã (em pixeis) os key points são desenhados como pontos em vez de círculos
+POINT_DETAIL = 4.0
+
+
+# converte pontos (N, 2) num QPolygonF escrevendo diretamente no seu buffer, sem criar N QPointF
+def to_polygon(points: np.ndarray) -> gui.QPolygonF:
+    polygon = gui.QPolygonF(len(points))
+    if len(points):
+        buffer = polygon.data()
+        buffer.setsize(len(points) * 2 * np.dtype(np.float64).itemsize)
+        np.frombuffer(buffer, dtype=np.float64).reshape(-1, 2)[:] = points
+    return polygon
+
+
+# Um único item da cena que desenha todos os key points de uma imagem, em vez de um QGraphicsItem
+# por key point. Só são desenhados os pontos dentro da área exposta (pesquisados no índice espacial),
+# numa passagem por cor (não selecionados e selecionados). Com pouco zoom os key points são pontos
+# desenhados de uma vez com drawPoints; com zoom suficiente passam a círculos com o diâmetro real
+class KeyPointLayer(qt.QGraphicsItem):
+    def __init__(self, points: np.ndarray, diameter=2.5):
+        super().__init__()
+        self.diameter = diameter
+        self.index = GridIndex(points)
+        self.selection = np.zeros(len(self.index), dtype=bool)
+        # sem esta flag o option.exposedRect é sempre o boundingRect inteiro e nada é descartado no paint
+        self.setFlag(qt.QGraphicsItem.ItemUsesExtendedStyleOption)
+        if len(self.index):
+            x0, y0 = self.index.points.min(axis=0) - diameter
+            x1, y1 = self.index.points.max(axis=0) + diameter
+            self._bounds = qtc.QRectF(float(x0), float(y0), float(x1 - x0), float(y1 - y0))
+        else:
+            self._bounds = qtc.QRectF()
+
+    def __len__(self):
+        return len(self.index)
+
+    def boundingRect(self) -> qtc.QRectF:
+        return self._bounds
+
+    def set_selection(self, selection: np.ndarray):
+        self.selection = selection
+        self.update()
+
+    # índices dos key points cujo círculo contém o ponto (x, y)
+    def at(self, x: float, y: float) -> np.ndarray:
+        return self.index.query_point(x, y, self.diameter / 2)
+
+    def paint(self, painter: gui.QPainter, option: qt.QStyleOptionGraphicsItem,
+              widget: typing.Optional[qt.QWidget] = ...):
+        exposed = option.exposedRect.adjusted(-self.diameter, -self.diameter, self.diameter, self.diameter)
+        visible = self.index.query_rect(exposed.left(), exposed.top(), exposed.right(), exposed.bottom())
+        if not len(visible):
+            return
+        scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        selected = self.selection[visible]
+        for mask, color in ((~selected, qtc.Qt.darkRed), (selected, qtc.Qt.green)):
+            points = self.index.points[visible[mask]]
+            if not len(points):
+                continue
+            if self.diameter * scale < POINT_DETAIL:
+                pen = gui.QPen(gui.QColor(color), max(self.diameter * scale, 1.0))
+                pen.setCosmetic(True)
+                pen.setCapStyle(qtc.Qt.RoundCap)
+                painter.setPen(pen)
+                painter.drawPoints(to_polygon(points))
+            else:
+                painter.setPen(qtc.Qt.NoPen)
+                painter.setBrush(gui.QColor(color))
+                radius = self.diameter / 2
+                for x, y in points.tolist():
+                    painter.drawEllipse(qtc.QPointF(x, y), radius, radius)
@@ -1,4 +1,5 @@
 import os
+from typing import Callable, List, Optional
 
 import cv2
 import numpy as np
@@ -8,19 +9,31 @@ from PyQt5 import (QtWidgets as qt,
 from PyQt5.QtCore import Qt
 
 import gui.utils as utils
-from gui.augment_items import BoxAugmentItem, ArrowAugmentItem, EllipseAugmentItem
+import gui.workers as workers
 from core import Database, Image, Matcher, Entry
-from core.augments import AugmentType
+from core import instrumentation
+from core.debug import DebugSink
+from core.feature_cache import FeatureCache
+from core.projection import ProjectedAugment, project
+from core.pipeline import recognize, RecognitionResult
 from gui import AddEntryWindow
+from gui.dev_console import DevConsole
+from gui.overlays import OverlayCache, projected_items
+from gui.performance_panel import PerformancePanel
+from gui.workers import Task
 from log import logger
 
 
 class MainWindow(qt.QMainWindow):
+    # resultados intermédios emitidos na thread do reconhecimento, entregues na thread principal
+    debug_result = qtc.pyqtSignal(str, object)
+
     def __init__(self):
         super().__init__()
-        self.database: Database = None
-        self.matcher: Matcher = Matcher()
-        self.database = Database.connect('dev.db')
+        self.database: Database = Database.connect('dev.db')
+        self.matcher: Matcher = Matcher(self.database.backend, feature_cache=FeatureCache())
+        self.matcher.attach(self.database)
+        self.overlays = OverlayCache(self.database)
         self.configure_window()
         self.configure_menubar()
         self.__entryWindow = None
@@ -28,6 +41,20 @@ class MainWindow(qt.QMainWindow):
         self.view = qt.QGraphicsView(self.scene)
         self.popup_list: EntriesList = None
         self.dev_console: DevConsole = None
+        # as imagens de debug só são criadas enquanto a consola de desenvolvimento estiver aberta
+        self.debug_sink = DebugSink()
+        self.debug_result.connect(self.add_dev_result)
+        self.performance_panel: PerformancePanel = None
+        self.__recognition: Task = None
+        self.__training: Optional[Task] = None
+        # etapa e melhor candidato (nome, inliers) da Task atual, mostrados na barra de estado
+        self.__recognition_stage = ''
+        self.__best_candidate = None
+        self.progress_bar = qt.QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.progress_bar)
         self.setCentralWidget(self.view)
         self.show()
 
@@ -51,6 +78,13 @@ class MainWindow(qt.QMainWindow):
         open_act.triggered.connect(self.open_image)
         file_menu.addAction(open_act)
 
+        self.cancel_act = qt.QAction('Cancel', self)
+        self.cancel_act.setShortcut('Esc')
+        self.cancel_act.setStatusTip('Cancel the running recognition or vocabulary training')
+        self.cancel_act.setDisabled(True)
+        self.cancel_act.triggered.connect(self.cancel_tasks)
+        file_menu.addAction(self.cancel_act)
+
         exit_action = qt.QAction('Quit', self)
         exit_action.setShortcut('Ctrl+Q')
         exit_action.setStatusTip('Quit application')
@@ -72,6 +106,11 @@ class MainWindow(qt.QMainWindow):
         list_entries_act.triggered.connect(self.list_entries)
         database_menu.addAction(list_entries_act)
 
+        self.train_vocabulary_act = qt.QAction('Train Vocabulary', self)
+        self.train_vocabulary_act.setStatusTip('Train a visual vocabulary to shortlist candidates in large databases')
+        self.train_vocabulary_act.triggered.connect(self.train_vocabulary)
+        database_menu.addAction(self.train_vocabulary_act)
+
         menubar.addAction(database_menu.menuAction())
 
         developer_menu = menubar.addMenu('Developer')
@@ -81,6 +120,18 @@ class MainWindow(qt.QMainWindow):
         results_view_act.triggered.connect(self.open_dev_console)
         developer_menu.addAction(results_view_act)
 
+        performance_act = qt.QAction('Performance', self)
+        performance_act.setStatusTip('Shows the time spent in each stage and the recognition counters')
+        performance_act.triggered.connect(self.open_performance_panel)
+        developer_menu.addAction(performance_act)
+
+        # os augments são projetados como geometria; o modo raster (warp da imagem dos augments) fica
+        # disponível para comparação
+        self.raster_augments_act = qt.QAction('Raster Augments', self)
+        self.raster_augments_act.setStatusTip('Warps a rendered image of the augments instead of projecting them')
+        self.raster_augments_act.setCheckable(True)
+        developer_menu.addAction(self.raster_augments_act)
+
         menubar.addAction(developer_menu.menuAction())
 
     def open_image(self):
@@ -88,89 +139,176 @@ class MainWindow(qt.QMainWindow):
                                                       'Images (*.png *.jpg)')
         if filename:
             image = Image.from_file(filename)
-            image_eq = self.matcher.histogram_equalization(image)
-            self.add_dev_result("Loaded imagem in grayscale", image.grayscale)
-            self.add_dev_result("Histogram Equalization", image_eq.src)
-            kp, des = self.matcher.features_raw(image_eq)
-            self.add_dev_result("Features in equalized image", Image(cv2.drawKeypoints(image_eq.src, kp, None)).rgb)
-            for entry in self.database.entries:
-                logger.debug("Trying to match against '%s'", entry.name)
-                matches = self.matcher.match(entry.descriptors, des)
-                logger.debug("Found %d/10 matches", len(matches))
-                if len(matches) >= 10:
-                    logger.info("Found a match in the database! (%s)", entry.name)
-                    src_pts = np.float32([entry.key_points[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-                    dst_pts = np.float32([kp[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-                    matrix, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
-                    matches_mask = mask.ravel().tolist()
-                    h, w, __ = entry.img.dimensions
-                    pts = np.float32([[0, 0], [0, h - 1], [w - 1, h - 1], [w - 1, 0]]).reshape(-1, 1, 2)
-                    dst = cv2.perspectiveTransform(pts, matrix)
-                    img_with_box = Image(cv2.polylines(np.copy(image.src), [np.int32(dst)], True, 255, 3, cv2.LINE_AA))
-                    match_res_img = Image(
-                        cv2.drawMatches(entry.img.src, entry.key_points, img_with_box.src, kp, matches,
-                                        None,
-                                        matchesMask=matches_mask,
-                                        flags=2, matchColor=(0, 255, 0),
-                                        singlePointColor=False))
-                    self.add_dev_result("Matching result with homography", match_res_img.rgb)
-                    # Prepare augments
-                    self.scene.clear()
-                    pen = gui.QPen()
-                    pen.setColor(Qt.red)
-                    pen.setWidth(5)
-                    for augment in entry.augments:
-                        if augment.type is AugmentType.BOX:
-                            box = BoxAugmentItem(augment.w, augment.h)
-                            box.setPos(augment.x, augment.y)
-                            self.scene.addItem(box)
-                        elif augment.type is AugmentType.ARROW:
-                            arrow = ArrowAugmentItem(augment.length)
-                            arrow.setPos(augment.x, augment.y)
-                            arrow.setRotation(augment.rotation)
-                            self.scene.addItem(arrow)
-                        elif augment.type is AugmentType.ELLIPSE:
-                            ellipse = EllipseAugmentItem(augment.w, augment.h)
-                            ellipse.setPos(augment.x, augment.y)
-                            self.scene.addItem(ellipse)
-                    # Save augments to image
-                    self.scene.setSceneRect(0, 0, w, h)
-                    augments_image = gui.QImage(w, h, gui.QImage.Format_ARGB32)
-                    augments_image.fill(Qt.transparent)
-                    painter = gui.QPainter(augments_image)
-                    self.scene.render(painter)
-                    painter.end()
-                    # Warp augments image based on homography matrix calculated above
-                    w, h, __ = image.dimensions
-                    augments_wrapped = cv2.warpPerspective(utils.qimage_to_numpy(augments_image), matrix,
-                                                           (w + 200, h + 200))
-                    augments_wrapped_image = gui.QImage(augments_wrapped, w + 200, h + 200, gui.QImage.Format_ARGB32)
-                    # Draw final result on screen
-                    self.scene.clear()
-                    item = self.scene.addPixmap(gui.QPixmap(utils.image_to_qimage(image)))
-                    self.scene.addPixmap(gui.QPixmap(augments_wrapped_image))
-                    self.scene.setSceneRect(item.boundingRect())
-                    self.view.fitInView(item, Qt.KeepAspectRatio)
-                    self.update()
-                    return
-            info_box = qt.QMessageBox(self)
-            info_box.setIcon(qt.QMessageBox.Warning)
-            info_box.setText("Couldn't find a matching entry in the database")
-            info_box.exec()
+            # o reconhecimento corre numa thread de fundo; a GUI só trata do resultado
+            self.cancel_recognition()
+            task = Task(self.__recognize, image, self.raster_augments_act.isChecked())
+            # uma Task cancelada pode ainda entregar sinais já em fila; só os da Task atual são tratados
+            task.signals.progress.connect(lambda stage, fraction: self.on_recognition_progress(task, stage, fraction))
+            task.signals.partial.connect(lambda candidate: self.on_recognition_candidate(task, *candidate))
+            task.signals.finished.connect(lambda result: self.on_recognition_finished(task, image, *result))
+            task.signals.failed.connect(lambda error: self.on_recognition_failed(task, error))
+            task.signals.cancelled.connect(lambda: self.on_recognition_done(task, 'Recognition cancelled'))
+            self.__recognition = workers.start(task)
+            self.__recognition_stage = 'queued'
+            self.__best_candidate = None
+            self.progress_bar.setValue(0)
+            self.update_task_controls()
+
+    # executado na thread de fundo: não pode tocar em widgets. Os augments também são projetados aqui,
+    # para que a thread principal só tenha de trocar o conteúdo da cena
+    def __recognize(self, task: Task, image: Image, raster: bool):
+        result = recognize(image, self.database, self.matcher, debug=self.debug_sink,
+                           token=task.token, progress=task.progress,
+                           on_candidate=lambda entry, inliers: task.partial((entry.name, inliers)))
+        projected = None
+        if result.matched and not raster:
+            projected = project(result.entry.augments, result.homography)
+        return result, projected
+
+    def cancel_recognition(self):
+        if self.__recognition is not None:
+            self.__recognition.cancel()
+
+    def cancel_tasks(self):
+        self.cancel_recognition()
+        if self.__training is not None:
+            self.__training.cancel()
+
+    # o botão de cancelar e a barra de progresso ficam visíveis enquanto houver uma Task por terminar
+    def update_task_controls(self):
+        idle = self.__recognition is None and self.__training is None
+        self.cancel_act.setDisabled(idle)
+        self.progress_bar.setHidden(idle)
+
+    def on_recognition_progress(self, task: Task, stage: str, fraction: float):
+        if task is self.__recognition:
+            self.__recognition_stage = stage
+            self.progress_bar.setValue(int(100 * fraction))
+            self.show_recognition_status()
+
+    def on_recognition_candidate(self, task: Task, name: str, inliers: int):
+        if task is self.__recognition:
+            self.__best_candidate = (name, inliers)
+            self.show_recognition_status()
+
+    def show_recognition_status(self):
+        message = 'Recognizing: %s' % self.__recognition_stage
+        if self.__best_candidate is not None:
+            message += " - best so far '%s' (%d inliers)" % self.__best_candidate
+        self.statusBar().showMessage(message)
+
+    # retorna False se a Task já tiver sido substituída por outra
+    def on_recognition_done(self, task: Task, message: str = 'Ready') -> bool:
+        if task is not self.__recognition:
+            return False
+        self.__recognition = None
+        self.update_task_controls()
+        self.statusBar().showMessage(message)
+        return True
+
+    def on_recognition_finished(self, task: Task, image: Image, result: RecognitionResult,
+                                projected: Optional[List[ProjectedAugment]]):
+        if self.on_recognition_done(task):
+            self.show_recognition(image, result, projected)
+
+    def on_recognition_failed(self, task: Task, error: str):
+        if self.on_recognition_done(task, 'Recognition failed'):
+            qt.QMessageBox.critical(self, 'Recognition failed', error)
+
+    # sem `projected` (augments já projetados) os augments são desenhados com o warp da imagem dos augments
+    def show_recognition(self, image: Image, result: RecognitionResult,
+                         projected: Optional[List[ProjectedAugment]] = None):
+        if result.matched:
+            entry, matrix = result.entry, result.homography
+            self.scene.clear()
+            item = self.scene.addPixmap(gui.QPixmap(utils.image_to_qimage(image)))
+            if projected is None:
+                # augments da entry já desenhados (ver OverlayCache), deformados pela homografia
+                h, w = image.dimensions[:2]
+                overlay = self.overlays.get(entry)
+                with instrumentation.span('warp_augments'):
+                    augments_warped = cv2.warpPerspective(overlay, matrix, (w, h))
+                self.scene.addPixmap(gui.QPixmap(gui.QImage(augments_warped, w, h, augments_warped.strides[0],
+                                                            gui.QImage.Format_ARGB32_Premultiplied)))
+            else:
+                # só os pontos de controlo dos augments passam pela homografia
+                for augment_item in projected_items(projected):
+                    augment_item.setParentItem(item)
+            self.scene.setSceneRect(item.boundingRect())
+            self.view.fitInView(item, Qt.KeepAspectRatio)
+            self.update()
+            return
+        info_box = qt.QMessageBox(self)
+        info_box.setIcon(qt.QMessageBox.Warning)
+        info_box.setText("Couldn't find a matching entry in the database")
+        info_box.exec()
 
     def open_add_entry_window(self):
         logger.debug('Opening an add database entry window')
         self.__entryWindow = AddEntryWindow(self.database, self.matcher)
+        self.__entryWindow.entry_saved.connect(self.prepare_overlay)
         pos = self.frameGeometry().topLeft()
         self.__entryWindow.move(pos.x() + 20, pos.y() + 20)
         self.__entryWindow.show()
 
+    def prepare_overlay(self, entry: Entry):
+        if self.raster_augments_act.isChecked():
+            self.overlays.prepare(entry)
+
     def list_entries(self):
         self.popup_list = EntriesList(self, self.database)
 
+    # o treino (k-means) pode demorar e altera a Database, por isso corre na thread de fundo, depois
+    # do reconhecimento em curso, com progresso e cancelamento
+    def train_vocabulary(self):
+        if self.__training is not None:
+            return
+        task = Task(lambda task: self.database.train_vocabulary(token=task.token, progress=task.progress))
+        task.signals.progress.connect(lambda stage, fraction: self.on_training_progress(task, stage, fraction))
+        task.signals.finished.connect(lambda vocabulary: self.on_training_done(
+            task, 'Trained a vocabulary with %d words' % len(vocabulary), qt.QMessageBox.information))
+        task.signals.failed.connect(lambda error: self.on_training_done(task, error, qt.QMessageBox.warning))
+        task.signals.cancelled.connect(lambda: self.on_training_done(task, 'Vocabulary training cancelled'))
+        self.__training = workers.start(task)
+        self.train_vocabulary_act.setDisabled(True)
+        self.progress_bar.setValue(0)
+        self.update_task_controls()
+        self.statusBar().showMessage('Training vocabulary: queued')
+
+    def on_training_progress(self, task: Task, stage: str, fraction: float):
+        if task is self.__training:
+            self.progress_bar.setValue(int(100 * fraction))
+            self.statusBar().showMessage('Training vocabulary: %s' % stage)
+
+    def on_training_done(self, task: Task, message: str, message_box: Optional[Callable] = None):
+        if task is not self.__training:
+            return
+        self.__training = None
+        self.train_vocabulary_act.setDisabled(False)
+        self.update_task_controls()
+        self.statusBar().showMessage(message)
+        if message_box is not None:
+            message_box(self, 'Train Vocabulary', message)
+
     def open_dev_console(self):
-        self.dev_console = DevConsole()
+        if self.dev_console is None:
+            self.dev_console = DevConsole()
+            self.dev_console.closed.connect(lambda: self.debug_sink.unsubscribe(self.forward_debug))
+        self.debug_sink.subscribe(self.forward_debug)
         self.dev_console.show()
+        self.dev_console.raise_()
+
+    # abrir o painel liga a instrumentação, que pode depois ser desligada no próprio painel
+    def open_performance_panel(self):
+        if self.performance_panel is None:
+            instrumentation.enable()
+            self.performance_panel = PerformancePanel()
+        self.performance_panel.show()
+        self.performance_panel.raise_()
+
+    # chamado na thread do reconhecimento
+    def forward_debug(self, text: str, image: np.ndarray):
+        self.debug_result.emit(text, image)
 
     def add_dev_result(self, text: str, img: np.array):
         if self.dev_console:
@@ -188,6 +326,7 @@ class MainWindow(qt.QMainWindow):
                                         qt.QMessageBox.No, qt.QMessageBox.No)
 
         if reply == qt.QMessageBox.Yes:
+            self.cancel_tasks()
             event.accept()
         else:
             event.ignore()
@@ -213,6 +352,8 @@ class EntriesList(qt.QWidget):
     def __init__(self, parent, database):
         super().__init__(parent)
         self.database = database
+        # remoções ainda na fila da thread de fundo
+        self.tasks = set()
 
         self.area = qt.QScrollArea()
         widget = qt.QWidget()
@@ -227,35 +368,22 @@ class EntriesList(qt.QWidget):
         self.area.setWidget(widget)
         self.area.show()
 
+    # a Database e o Matcher só são alterados na thread de fundo, para não mudarem a meio de um
+    # reconhecimento; a entry só sai da lista depois de ter sido removida
     def delete_entry(self, entry: ListEntry):
-        self.database.remove_entry(entry.entry)
+        entry.setDisabled(True)
+        task = Task(lambda task, removed: self.database.remove_entry(removed), entry.entry)
+        task.signals.finished.connect(lambda __: self.on_entry_deleted(task, entry))
+        task.signals.failed.connect(lambda error: self.on_delete_failed(task, entry, error))
+        self.tasks.add(workers.start(task))
+
+    def on_entry_deleted(self, task: Task, entry: ListEntry):
+        self.tasks.discard(task)
         self.layout.removeWidget(entry)
         entry.deleteLater()
         self.layout.update()
 
-
-class DevConsole(qt.QWidget):
-    def __init__(self):
-        super().__init__()
-        self.main_layout = qt.QVBoxLayout()
-        self.scroll_area = qt.QScrollArea()
-        self.scroll_widget = qt.QWidget()
-        self.scroll_layout = qt.QVBoxLayout()
-        self.scroll_layout.setContentsMargins(0, 0, 0, 0)
-        self.scroll_widget.setLayout(self.scroll_layout)
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setWidget(self.scroll_widget)
-        self.main_layout.addWidget(self.scroll_area)
-        self.setLayout(self.main_layout)
-
-    def add_result(self, text: str, image: np.array):
-        widget = qt.QWidget()
-        layout = qt.QGridLayout()
-        layout.setContentsMargins(0, 0, 0, 0)
-        img = utils.numpy_to_qimage(image)
-        label = qt.QLabel()
-        label.setPixmap(gui.QPixmap(img))
-        layout.addWidget(label, 0, 0, Qt.AlignCenter)
-        layout.addWidget(qt.QLabel(text), 1, 0, Qt.AlignCenter)
-        widget.setLayout(layout)
-        self.scroll_layout.insertWidget(0, widget)
+    def on_delete_failed(self, task: Task, entry: ListEntry, error: str):
+        self.tasks.discard(task)
+        entry.setDisabled(False)
+        qt.QMessageBox.critical(self, 'Delete Entry', error)
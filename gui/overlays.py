@@ -0,0 +1,104 @@
+from typing import List
+
+import numpy as np
+from PyQt5 import (QtWidgets as qt,
+                   QtGui as gui)
+from PyQt5.QtCore import Qt
+
+from core import Database, Entry
+from core import instrumentation
+from core.augments import Augment, AugmentType
+from core.cache import LRUCache
+from core.index import entry_key
+from core.projection import ProjectedAugment
+from gui.augment_items import AugmentItem, BoxAugmentItem, ArrowAugmentItem, EllipseAugmentItem
+from gui.key_point_layer import to_polygon
+from log import logger
+
+OVERLAY_CACHE_BYTES = 128 * 1024 * 1024
+
+
+def augment_items(augments: List[Augment]) -> List[AugmentItem]:
+    items = []
+    for augment in augments:
+        if augment.type is AugmentType.BOX:
+            item = BoxAugmentItem(augment.w, augment.h)
+            item.setPos(augment.x, augment.y)
+        elif augment.type is AugmentType.ARROW:
+            item = ArrowAugmentItem(augment.length)
+            item.setPos(augment.x, augment.y)
+            item.setRotation(augment.rotation)
+        elif augment.type is AugmentType.ELLIPSE:
+            item = EllipseAugmentItem(augment.w, augment.h)
+            item.setPos(augment.x, augment.y)
+        else:
+            continue
+        items.append(item)
+    return items
+
+
+# items da cena com os augments já projetados na imagem de query (ver core.projection): são desenhados
+# pelo Qt à resolução do ecrã, sem passar por uma imagem intermédia do tamanho da entry
+def projected_items(projected: List[ProjectedAugment]) -> List[qt.QGraphicsPathItem]:
+    items = []
+    for augment in projected:
+        polygon = to_polygon(augment.points)
+        if augment.closed:
+            polygon.append(polygon.first())
+        path = gui.QPainterPath()
+        path.addPolygon(polygon)
+        pen = gui.QPen(gui.QColor(255, 0, 0), augment.width)
+        if augment.augment.type is AugmentType.ARROW:
+            pen.setCapStyle(Qt.RoundCap)
+            pen.setJoinStyle(Qt.RoundJoin)
+        item = qt.QGraphicsPathItem(path)
+        item.setPen(pen)
+        items.append(item)
+    return items
+
+
+# desenha os augments de uma entry numa imagem transparente do tamanho da imagem da entry.
+# Retorna um array (h, w, 4) com alpha pré-multiplicado, na ordem de bytes do QImage (BGRA)
+def render_overlay(entry: Entry) -> np.ndarray:
+    h, w = entry.img.dimensions[:2]
+    scene = qt.QGraphicsScene()
+    for item in augment_items(entry.augments):
+        scene.addItem(item)
+    scene.setSceneRect(0, 0, w, h)
+    image = gui.QImage(w, h, gui.QImage.Format_ARGB32_Premultiplied)
+    image.fill(Qt.transparent)
+    painter = gui.QPainter(image)
+    scene.render(painter)
+    painter.end()
+    buffer = image.constBits()
+    buffer.setsize(image.byteCount())
+    overlay = np.frombuffer(buffer, dtype=np.uint8).reshape(h, image.bytesPerLine() // 4, 4)[:, :w].copy()
+    overlay.setflags(write=False)
+    return overlay
+
+
+# Cache das imagens dos augments de cada entry: como só dependem da entry, são desenhadas uma vez
+# (quando a entry é guardada ou usada pela primeira vez) em vez de em cada reconhecimento.
+# Uma entry alterada é substituída na base de dados, o que invalida a sua imagem
+class OverlayCache:
+    def __init__(self, database: Database, max_bytes: int = OVERLAY_CACHE_BYTES):
+        self._overlays = LRUCache(max_bytes)
+        database.subscribe(self.invalidate)
+
+    def invalidate(self, key: str):
+        self._overlays.discard(key)
+
+    def get(self, entry: Entry) -> np.ndarray:
+        key = entry_key(entry.name)
+        cached = self._overlays.get(key)
+        # a entry pode ter sido substituída por outra com o mesmo nome
+        if cached is not None and cached[0] is entry:
+            return cached[1]
+        logger.debug("Rendering the augments of '%s'", entry.name)
+        with instrumentation.span('render_augments'):
+            overlay = render_overlay(entry)
+        self._overlays.put(key, (entry, overlay), overlay.nbytes)
+        return overlay
+
+    def prepare(self, entry: Entry):
+        self.get(entry)
@@ -0,0 +1,82 @@
+from PyQt5 import (QtWidgets as qt,
+                   QtCore as qtc)
+
+from core import instrumentation
+
+# intervalo de atualização do painel, em milissegundos
+REFRESH_INTERVAL = 500
+
+SPAN_COLUMNS = ('Span', 'Count', 'Mean ms', 'Min ms', 'Max ms', 'Last ms', 'Total ms')
+
+
+# Painel com os spans e contadores da instrumentação (ver core.instrumentation), atualizado
+# periodicamente enquanto está visível. A instrumentação só está ligada com a opção "Enabled"
+class PerformancePanel(qt.QWidget):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle('Performance')
+        layout = qt.QVBoxLayout()
+        controls = qt.QHBoxLayout()
+        self.enabled_box = qt.QCheckBox('Enabled')
+        self.enabled_box.setChecked(instrumentation.enabled())
+        self.enabled_box.toggled.connect(instrumentation.enable)
+        controls.addWidget(self.enabled_box)
+        controls.addStretch()
+        reset_btn = qt.QPushButton('Reset')
+        reset_btn.released.connect(self.reset)
+        controls.addWidget(reset_btn)
+        export_btn = qt.QPushButton('Export...')
+        export_btn.released.connect(self.export)
+        controls.addWidget(export_btn)
+        layout.addLayout(controls)
+
+        self.spans = qt.QTableWidget(0, len(SPAN_COLUMNS))
+        self.spans.setHorizontalHeaderLabels(SPAN_COLUMNS)
+        self.spans.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.spans.verticalHeader().hide()
+        layout.addWidget(self.spans)
+        self.counters = qt.QTableWidget(0, 2)
+        self.counters.setHorizontalHeaderLabels(('Counter', 'Total'))
+        self.counters.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.counters.verticalHeader().hide()
+        layout.addWidget(self.counters)
+        self.setLayout(layout)
+        self.resize(720, 480)
+
+        self.timer = qtc.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(REFRESH_INTERVAL)
+        self.refresh()
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        values = instrumentation.snapshot()
+        spans = sorted(values['spans'].items())
+        self.spans.setRowCount(len(spans))
+        for row, (name, stats) in enumerate(spans):
+            cells = (name, str(stats['count'])) + tuple(
+                '%.3f' % (1000 * stats[field]) for field in ('mean_s', 'min_s', 'max_s', 'last_s', 'total_s'))
+            for column, text in enumerate(cells):
+                self.spans.setItem(row, column, qt.QTableWidgetItem(text))
+        counters = sorted(values['counters'].items())
+        self.counters.setRowCount(len(counters))
+        for row, (name, value) in enumerate(counters):
+            self.counters.setItem(row, 0, qt.QTableWidgetItem(name))
+            self.counters.setItem(row, 1, qt.QTableWidgetItem('%g' % value))
+
+    def reset(self):
+        instrumentation.reset()
+        self.refresh()
+
+    # guarda os valores acumulados no formato de texto do Prometheus
+    def export(self):
+        filename, __ = qt.QFileDialog.getSaveFileName(self, 'Export Metrics', 'metrics.prom',
+                                                      'Prometheus text (*.prom *.txt)')
+        if filename:
+            with open(filename, 'w') as file:
+                file.write(instrumentation.prometheus_text())
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
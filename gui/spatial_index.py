@@ -0,0 +1,59 @@
+import math
+
+import numpy as np
+
+# número médio de pontos por célula da grelha
+POINTS_PER_CELL = 16
+
+
+# Índice espacial de pontos 2D numa grelha uniforme. Os pontos são ordenados pela célula onde caem,
+# por isso os pontos de uma linha de células consecutivas formam um intervalo contíguo e uma pesquisa
+# por retângulo é feita com alguns slices e uma comparação vetorizada, sem percorrer todos os pontos
+class GridIndex:
+    def __init__(self, points: np.ndarray, points_per_cell: int = POINTS_PER_CELL):
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        n = len(self.points)
+        if n:
+            self.origin = self.points.min(axis=0)
+            extent = np.maximum(self.points.max(axis=0) - self.origin, 1.0)
+        else:
+            self.origin = np.zeros(2, dtype=np.float32)
+            extent = np.ones(2, dtype=np.float32)
+        self.cell = max(math.sqrt(float(extent[0] * extent[1]) * points_per_cell / max(n, 1)), 1.0)
+        self.cols = int(extent[0] // self.cell) + 1
+        self.rows = int(extent[1] // self.cell) + 1
+        cells = self._cells(self.points)
+        self.order = np.argsort(cells, kind='stable')
+        # starts[c]:starts[c + 1] são as posições em `order` dos pontos da célula c
+        self.starts = np.searchsorted(cells[self.order], np.arange(self.rows * self.cols + 1))
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cells(self, points: np.ndarray) -> np.ndarray:
+        col, row = self._coords(points[:, 0], points[:, 1])
+        return row * self.cols + col
+
+    def _coords(self, x, y):
+        col = np.clip(((x - self.origin[0]) // self.cell).astype(np.int64), 0, self.cols - 1)
+        row = np.clip(((y - self.origin[1]) // self.cell).astype(np.int64), 0, self.rows - 1)
+        return col, row
+
+    # índices dos pontos dentro do retângulo [x0, x1] x [y0, y1]
+    def query_rect(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        if not len(self) or x1 < self.origin[0] or y1 < self.origin[1]:
+            return np.empty(0, dtype=np.int64)
+        (c0, c1), (r0, r1) = self._coords(np.array([x0, x1]), np.array([y0, y1]))
+        slices = [self.order[self.starts[r * self.cols + c0]:self.starts[r * self.cols + c1 + 1]]
+                  for r in range(r0, r1 + 1)]
+        candidates = np.concatenate(slices)
+        x, y = self.points[candidates, 0], self.points[candidates, 1]
+        return candidates[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+
+    # índices dos pontos a uma distância de (x, y) não superior a `radius`
+    def query_point(self, x: float, y: float, radius: float) -> np.ndarray:
+        candidates = self.query_rect(x - radius, y - radius, x + radius, y + radius)
+        d = self.points[candidates] - np.float32([x, y])
+        return candidates[(d ** 2).sum(axis=1) <= radius ** 2]
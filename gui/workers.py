@@ -0,0 +1,72 @@
+from typing import Any, Callable
+
+from PyQt5 import QtCore as qtc
+
+from core.cancellation import Cancelled, CancellationToken
+from log import logger
+
+
+# Os sinais têm de viver num QObject; como são emitidos na thread do worker e os objetos ligados
+# vivem na thread principal, o Qt entrega-os através do event loop da thread principal
+class TaskSignals(qtc.QObject):
+    progress = qtc.pyqtSignal(str, float)
+    # resultados parciais, antes de o trabalho terminar
+    partial = qtc.pyqtSignal(object)
+    finished = qtc.pyqtSignal(object)
+    failed = qtc.pyqtSignal(str)
+    cancelled = qtc.pyqtSignal()
+
+
+# Trabalho pesado (extração de features, matching, RANSAC) executado fora da thread do Qt.
+# `fn` recebe a própria Task como primeiro argumento, para poder usar o token e reportar progresso.
+# Só um dos sinais finished/failed/cancelled é emitido, sempre no fim do trabalho
+class Task(qtc.QRunnable):
+    def __init__(self, fn: Callable[..., Any], *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.token = CancellationToken()
+        self.signals = TaskSignals()
+        # quem lança a Task guarda uma referência para a poder cancelar; o QThreadPool não a deve apagar
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        self.token.cancel()
+
+    def progress(self, stage: str, fraction: float):
+        self.signals.progress.emit(stage, fraction)
+
+    def partial(self, value: Any):
+        self.signals.partial.emit(value)
+
+    def run(self):
+        try:
+            result = self.fn(self, *self.args)
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except Exception as error:
+            logger.exception('Background task failed')
+            self.signals.failed.emit(str(error))
+        else:
+            if self.token.cancelled:
+                self.signals.cancelled.emit()
+            else:
+                self.signals.finished.emit(result)
+
+
+_pool = None
+
+
+# O Matcher e a Database não são thread-safe, por isso todo o trabalho da GUI corre numa única
+# thread de fundo: uma Task nova só começa depois de a anterior terminar (ou ser cancelada)
+def pool() -> qtc.QThreadPool:
+    global _pool
+    if _pool is None:
+        _pool = qtc.QThreadPool()
+        _pool.setMaxThreadCount(1)
+    return _pool
+
+
+def start(task: Task) -> Task:
+    pool().start(task)
+    return task
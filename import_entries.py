@@ -0,0 +1,152 @@
+import argparse
+import json
+import multiprocessing
+import os
+from typing import Callable, List, Tuple
+
+import cv2
+
+from core import Database, Entry, Image, Matcher
+from core.augments import Augment
+from core.backends import BACKENDS, DEFAULT_BACKEND, backend as get_backend
+from core.feature import key_points_to_array, spread_key_points
+from core.image import LazyImage
+from core.matcher import MIN_MATCH_COUNT
+from core.preprocessing import Preprocessing
+from core.storage import PNG_COMPRESSION
+from recognize import find_images
+from log import logger
+
+# número de features escolhidas automaticamente para cada entry
+FEATURES = 500
+GRID = 8
+
+# estado de cada processo do pool
+_matcher: Matcher = None
+_features = FEATURES
+
+
+def init_worker(backend: str, threads: int, features: int, preprocessing: List[dict]):
+    global _matcher, _features
+    cv2.setNumThreads(threads)
+    _matcher = Matcher(backend, preprocessing=Preprocessing.from_config(preprocessing))
+    _features = features
+
+
+# lê o ficheiro <imagem>.json opcional, com o nome, o grupo e os augments da entry:
+# {"name": "...", "group": "...", "augments": [{"type": "box", "x": 10, "y": 20, "w": 100, "h": 50}]}
+def read_sidecar(path: str) -> dict:
+    sidecar = os.path.splitext(path)[0] + '.json'
+    if not os.path.exists(sidecar):
+        return {}
+    with open(sidecar) as file:
+        data = json.load(file)
+    if not isinstance(data, dict):
+        raise ValueError('%s must contain a JSON object' % sidecar)
+    return data
+
+
+# executado nos processos do pool: extrai as features, escolhe as melhores e comprime a imagem,
+# para que o processo principal só tenha de as escrever
+def process(path: str) -> dict:
+    image = Image.from_file(path)
+    if image.src is None:
+        return {'path': path, 'error': 'Could not read image'}
+    key_points, descriptors = _matcher.extract(image)
+    if descriptors is None or len(key_points) < MIN_MATCH_COUNT:
+        return {'path': path, 'error': 'Only %d features found' % len(key_points)}
+    array = key_points_to_array(key_points)
+    keep = spread_key_points(array, image.dimensions, _features, GRID)
+    ok, png = cv2.imencode('.png', image.src, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+    if not ok:
+        return {'path': path, 'error': 'Could not encode image'}
+    return {'path': path,
+            'key_points': array[keep],
+            'descriptors': descriptors[keep],
+            'png': png.tobytes(),
+            'shape': image.dimensions}
+
+
+def constant(value: bytes) -> Callable[[], bytes]:
+    return lambda: value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Imports every image of a directory as a database entry, '
+                                                 'selecting its features automatically')
+    parser.add_argument('database', help='database file (ex: dev.db)')
+    parser.add_argument('images', nargs='+', help='images or directories with images')
+    parser.add_argument('-n', '--features', type=int, default=FEATURES,
+                        help='features kept per entry, the strongest spread over the image (default: %d)' % FEATURES)
+    parser.add_argument('-g', '--group', default=None, help='group of entries without a group in their sidecar')
+    parser.add_argument('-b', '--backend', default=None, choices=sorted(BACKENDS),
+                        help='feature backend of a new database (default: %s)' % DEFAULT_BACKEND)
+    parser.add_argument('--preprocessing', type=json.loads, default=None, metavar='JSON',
+                        help='preprocessing stages of a new database, ex: \'[{"type": "grayscale"}, '
+                             '{"type": "clahe", "clip_limit": 2.0}]\' (default: grayscale and CLAHE)')
+    parser.add_argument('--replace', action='store_true', help='replace entries that already exist')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='write the entries every BATCH images instead of once at the end')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('-t', '--threads', type=int, default=None,
+                        help='OpenCV threads per worker (default: cores / workers)')
+    args = parser.parse_args(argv)
+    if args.features < MIN_MATCH_COUNT:
+        parser.error('at least %d features are needed per entry' % MIN_MATCH_COUNT)
+
+    try:
+        # o detetor é criado aqui uma vez, porque se falhar nos processos do pool o pool nunca termina
+        if args.backend is not None:
+            get_backend(args.backend).check()
+        database = Database.connect(args.database, backend=args.backend, preprocessing=args.preprocessing)
+        get_backend(database.backend).check()
+    except ValueError as error:
+        parser.error(str(error))
+    jobs: List[Tuple[str, dict]] = []
+    for path in find_images(args.images):
+        try:
+            meta = read_sidecar(path)
+            meta['augments'] = [Augment.from_dict(a) for a in meta.get('augments', [])]
+        except ValueError as error:
+            logger.warning('Skipping %s: %s', path, error)
+            continue
+        meta.setdefault('name', os.path.basename(path))
+        meta.setdefault('group', args.group)
+        if database.entry(meta['name']) is not None and not args.replace:
+            logger.info("Skipping %s: entry '%s' already exists", path, meta['name'])
+            continue
+        jobs.append((path, meta))
+
+    workers = max(1, args.workers)
+    threads = args.threads if args.threads is not None else max(1, (os.cpu_count() or 1) // workers)
+    logger.info('Importing %d images with %d workers (%d threads each)', len(jobs), workers, threads)
+    metas = dict(jobs)
+    pending: List[Entry] = []
+    imported = 0
+
+    def flush():
+        nonlocal imported
+        database.add_entries(pending)
+        imported += len(pending)
+        pending.clear()
+
+    with multiprocessing.Pool(workers, initializer=init_worker,
+                              initargs=(database.backend, threads, args.features,
+                                        database.preprocessing.to_config())) as pool:
+        for result in pool.imap(process, [path for path, __ in jobs]):
+            path = result['path']
+            if 'error' in result:
+                logger.warning('Skipping %s: %s', path, result['error'])
+                continue
+            meta = metas[path]
+            image = LazyImage(constant(result['png']), result['shape'], database.images)
+            pending.append(Entry(meta['name'], image, result['key_points'], result['descriptors'],
+                                 augments=meta['augments'], group=meta['group']))
+            if args.batch and len(pending) >= args.batch:
+                flush()
+    flush()
+    logger.info('Imported %d/%d images into %s', imported, len(jobs), args.database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from typing import Iterator, List, Optional
+
+import cv2
+
+from core import Database, Image, Matcher, instrumentation
+from core.backends import backend as get_backend
+from core.feature_cache import DEFAULT_FEATURE_CACHE_DIR, FeatureCache
+from core.pipeline import recognize
+from core.resolution import DEFAULT_MAX_EDGE, ResolutionPolicy
+from log import logger
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# estado de cada processo do pool: a base de dados é carregada uma única vez por processo
+_database: Database = None
+_matcher: Matcher = None
+_groups: Optional[List[str]] = None
+_resolution: ResolutionPolicy = None
+# eventos da instrumentação ainda não enviados ao processo principal (None se estiver desligada)
+_events: Optional[List[dict]] = None
+
+
+def init_worker(database: str, threads: int, groups: Optional[List[str]], resolution: ResolutionPolicy,
+                feature_cache: Optional[str], metrics: bool = False):
+    global _database, _matcher, _groups, _resolution, _events
+    # cada processo usa poucas threads do OpenCV para não haver mais threads do que cores
+    cv2.setNumThreads(threads)
+    _database = Database.connect(database)
+    _matcher = Matcher(_database.backend, feature_cache=FeatureCache(feature_cache) if feature_cache else None)
+    _matcher.attach(_database)
+    _groups = groups
+    _resolution = resolution
+    if metrics:
+        _events = []
+        instrumentation.enable()
+        instrumentation.add_exporter(_events.append)
+
+
+def process(path: str) -> dict:
+    image = Image.from_file(path)
+    if image.src is None:
+        return {'image': path, 'error': 'Could not read image'}
+    result = dict(recognize(image, _database, _matcher, groups=_groups, resolution=_resolution).to_dict(),
+                  image=path)
+    # os eventos seguem com o resultado para serem acumulados e exportados no processo principal
+    if _events is not None:
+        result['metrics'] = list(_events)
+        _events.clear()
+    return result
+
+
+def find_images(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for root, __, files in os.walk(path):
+                for filename in sorted(files):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recognizes query images against an image database, '
+                                                 'writing one JSON result per line')
+    parser.add_argument('database', help='database file (ex: dev.db)')
+    parser.add_argument('images', nargs='+', help='query images or directories with query images')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('-t', '--threads', type=int, default=None,
+                        help='OpenCV threads per worker (default: cores / workers)')
+    parser.add_argument('-g', '--group', action='append', dest='groups', default=None,
+                        help='only search entries of this group (can be repeated)')
+    parser.add_argument('--max-edge', type=int, default=DEFAULT_MAX_EDGE,
+                        help='detect features on query images downscaled to this long edge, 0 for full resolution '
+                             '(default: %d)' % DEFAULT_MAX_EDGE)
+    parser.add_argument('--max-key-points', type=int, default=None,
+                        help='keep only the strongest key points of each query image')
+    parser.add_argument('--feature-cache', default=DEFAULT_FEATURE_CACHE_DIR, metavar='DIR',
+                        help='directory of the on-disk feature cache, empty to disable (default: %s)'
+                             % DEFAULT_FEATURE_CACHE_DIR)
+    parser.add_argument('-o', '--output', default=None, help='output file (default: stdout)')
+    parser.add_argument('--metrics', default=None, metavar='JSONL',
+                        help='append the timing spans and counters of every stage to this JSON lines file')
+    parser.add_argument('--metrics-port', type=int, default=None, metavar='PORT',
+                        help='serve the accumulated metrics in the Prometheus text format while running')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.database):
+        parser.error("database '%s' does not exist" % args.database)
+    # o detetor é criado aqui uma vez, porque se falhar no initializer dos processos o pool nunca termina
+    try:
+        get_backend(Database.connect(args.database).backend).check()
+    except ValueError as error:
+        parser.error(str(error))
+    resolution = ResolutionPolicy(args.max_edge or None, args.max_key_points)
+    workers = max(1, args.workers)
+    threads = args.threads if args.threads is not None else max(1, (os.cpu_count() or 1) // workers)
+    images = list(find_images(args.images))
+    logger.info('Recognizing %d images with %d workers (%d threads each)', len(images), workers, threads)
+
+    metrics = args.metrics is not None or args.metrics_port is not None
+    exporter, server = None, None
+    output = open(args.output, 'w') if args.output else sys.stdout
+    matched = 0
+    try:
+        initargs = (args.database, threads, args.groups, resolution, args.feature_cache, metrics)
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+            # só depois de criar os processos, para não serem herdados por eles
+            if args.metrics:
+                exporter = instrumentation.JsonLinesExporter(args.metrics)
+                instrumentation.add_exporter(exporter)
+            if args.metrics_port is not None:
+                server = instrumentation.serve_prometheus(args.metrics_port)
+            for result in pool.imap_unordered(process, images):
+                for event in result.pop('metrics', ()):
+                    instrumentation.record(event)
+                matched += result.get('entry') is not None
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if exporter is not None:
+            exporter.close()
+        if server is not None:
+            server.shutdown()
+    logger.info('Matched %d/%d images', matched, len(images))
+
+
+if __name__ == '__main__':
+    main()
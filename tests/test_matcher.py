@@ -0,0 +1,28 @@
+import unittest
+
+import numpy as np
+
+from core.matcher import Matcher
+
+
+# Um Matcher sem attach() não é avisado das alterações da base de dados; a mesma chave pode
+# passar a corresponder a outros descritores
+class IndexCacheTest(unittest.TestCase):
+    def test_rebuilds_index_for_different_descriptors(self):
+        matcher = Matcher()
+        rng = np.random.RandomState(0)
+        first = rng.rand(500, 128).astype(np.float32)
+        second = first[:200].copy()
+        matcher.knn_search(first, first[:10], key='index')
+        indices, __ = matcher.knn_search(second, second[:10], key='index')
+        self.assertLess(indices.max(), len(second))
+        np.testing.assert_array_equal(indices[:, 0], np.arange(10))
+
+    def test_reuses_index_for_same_descriptors(self):
+        matcher = Matcher()
+        descriptors = np.random.RandomState(1).rand(300, 128).astype(np.float32)
+        self.assertIs(matcher.index('index', descriptors), matcher.index('index', descriptors))
+
+
+if __name__ == '__main__':
+    unittest.main()
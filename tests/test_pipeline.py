@@ -0,0 +1,51 @@
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from core import pipeline
+
+
+class FakeEntry:
+    def __init__(self, name: str):
+        self.name = name
+
+
+# homografia falsa com `inliers[entry]` inliers; regista as entries verificadas
+class FakeHomography:
+    def __init__(self, inliers: dict):
+        self.inliers = inliers
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, entry, matches, key_points):
+        with self.lock:
+            self.calls.append(entry.name)
+        mask = np.zeros((len(matches), 1), dtype=np.uint8)
+        mask[:self.inliers[entry.name]] = 1
+        return np.eye(3), mask
+
+
+class VerifyTest(unittest.TestCase):
+    def candidates(self, votes: dict):
+        return [(FakeEntry(name), [None] * count) for name, count in votes.items()]
+
+    def test_decisive_winner_skips_remaining_candidates(self):
+        fake = FakeHomography({'a': 90, 'b': 40, 'c': 30, 'd': 20, 'e': 10})
+        with mock.patch.object(pipeline, 'homography', fake), mock.patch.object(pipeline, 'VERIFY_THREADS', 2):
+            entry, __, __, mask = pipeline.verify(self.candidates({'a': 100, 'b': 80, 'c': 60, 'd': 50, 'e': 40}), [])
+        self.assertEqual(entry.name, 'a')
+        self.assertEqual(int(mask.sum()), 90)
+        self.assertEqual(sorted(fake.calls), ['a', 'b'])
+
+    def test_best_inliers_win_over_votes(self):
+        fake = FakeHomography({'a': 5, 'b': 70, 'c': 60})
+        with mock.patch.object(pipeline, 'homography', fake), mock.patch.object(pipeline, 'VERIFY_THREADS', 1):
+            entry = pipeline.verify(self.candidates({'a': 100, 'b': 80, 'c': 60}), [])[0]
+        self.assertEqual(entry.name, 'b')
+        self.assertEqual(fake.calls, ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from core.database import Database, Entry
+from core.feature import KEY_POINT_DTYPE
+from core.image import Image, LazyImage
+
+
+def make_entry(name: str, rows: int, seed: int) -> Entry:
+    rng = np.random.RandomState(seed)
+    image = Image(rng.randint(0, 256, (32, 48, 3)).astype(np.uint8))
+    key_points = np.zeros(rows, dtype=KEY_POINT_DTYPE)
+    key_points['x'] = rng.uniform(0, 48, rows)
+    key_points['y'] = rng.uniform(0, 32, rows)
+    return Entry(name, image, key_points, rng.rand(rows, 128).astype(np.float32))
+
+
+# Recuperação depois de o processo morrer entre a escrita dos dados de uma entry e a do seu registo no log
+class CrashRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.db')
+        Database.connect(self.filename).add_entry(make_entry('a', 30, 0))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def data_file(self, kind: str) -> str:
+        files = [f for f in os.listdir(self.directory) if f.endswith('.' + kind)]
+        self.assertEqual(len(files), 1)
+        return os.path.join(self.directory, files[0])
+
+    def assert_entries(self, database: Database, expected: dict):
+        self.assertEqual({e.name: len(e) for e in database.entries}, {n: len(e) for n, e in expected.items()})
+        for name, entry in expected.items():
+            stored = database.entry(name)
+            np.testing.assert_array_equal(stored.descriptors, entry.descriptors)
+            np.testing.assert_array_equal(stored.key_point_array, entry.key_point_array)
+            np.testing.assert_array_equal(stored.img.src, entry.img.src)
+
+    def test_orphan_descriptor_rows(self):
+        with open(self.data_file('descriptors'), 'ab') as file:
+            file.write(np.ones((20, 128), dtype=np.float32).tobytes())
+        Database.connect(self.filename).add_entry(make_entry('b', 10, 1))
+        self.assert_entries(Database.connect(self.filename), {'a': make_entry('a', 30, 0),
+                                                             'b': make_entry('b', 10, 1)})
+
+    def test_orphan_data_in_every_column(self):
+        for kind in ('descriptors', 'keypoints', 'words', 'images'):
+            with open(self.data_file(kind), 'ab') as file:
+                file.write(b'\x01' * 1000)
+        database = Database.connect(self.filename)
+        self.assert_entries(database, {'a': make_entry('a', 30, 0)})
+        database.add_entry(make_entry('b', 10, 1))
+        self.assert_entries(Database.connect(self.filename), {'a': make_entry('a', 30, 0),
+                                                             'b': make_entry('b', 10, 1)})
+
+
+
+# as imagens das entries adicionadas durante a sessão passam a ser lidas do disco depois de escritas
+class LazyImageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_added_images_are_lazy(self):
+        database = Database.connect(os.path.join(self.directory, 'test.db'))
+        entry = make_entry('a', 30, 0)
+        pixels = entry.img.src.copy()
+        database.add_entry(entry)
+        stored = database.entry('a')
+        self.assertIsInstance(stored.img, LazyImage)
+        self.assertEqual(stored.img.dimensions, pixels.shape)
+        np.testing.assert_array_equal(stored.img.src, pixels)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from core.database import Database, Entry
+from core.feature import KEY_POINT_DTYPE
+from core.image import Image
+from core.vocabulary import Vocabulary
+
+
+def make_entry(name: str, rows: int, seed: int) -> Entry:
+    rng = np.random.RandomState(seed)
+    key_points = np.zeros(rows, dtype=KEY_POINT_DTYPE)
+    return Entry(name, Image(rng.randint(0, 256, (16, 16)).astype(np.uint8)), key_points,
+                 rng.rand(rows, 128).astype(np.float32))
+
+
+# Um vocabulário que não quantizou as entries guardadas (ex: ficheiro substituído) só é aplicado em
+# memória ao abrir a base de dados; os ficheiros só mudam com um save() explícito
+class StaleVocabularyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.db')
+        database = Database.connect(self.filename)
+        database.add_entries([make_entry('a', 100, 0), make_entry('b', 100, 1)])
+        database.train_vocabulary(branching=2, depth=2)
+        self.vocabulary = Vocabulary.train(np.random.RandomState(2).rand(200, 128), branching=2, depth=2)
+        self.vocabulary.save(self.filename + '.vocab')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def files(self) -> dict:
+        return {name: os.path.getmtime(os.path.join(self.directory, name)) for name in os.listdir(self.directory)}
+
+    def test_connect_quantizes_in_memory(self):
+        before = self.files()
+        database = Database.connect(self.filename)
+        self.assertEqual(self.files(), before)
+        self.assertEqual(database.vocabulary.id, self.vocabulary.id)
+        for entry in database.entries:
+            np.testing.assert_array_equal(entry.words, self.vocabulary.quantize(entry.descriptors))
+
+    def test_save_persists_the_words(self):
+        Database.connect(self.filename).save()
+        database = Database.connect(self.filename)
+        for entry in database.entries:
+            np.testing.assert_array_equal(entry.words, self.vocabulary.quantize(entry.descriptors))
+
+
+if __name__ == '__main__':
+    unittest.main()